@@ -1,7 +1,11 @@
 import os
 import sys
+import copy
+import json
+import queue
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from vu_filesystem import VU_FileSystem
 
 def colorize(data, color):
@@ -55,6 +59,60 @@ def default_formatter():
 
     return logging.Formatter(fmt, "%b %d %Y %H:%M:%S")
 
+def file_formatter():
+    return logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, for log collectors
+    def format(self, record):
+        entry = {
+            'time': f'{self.formatTime(record, "%Y-%m-%dT%H:%M:%S")}.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'pid': record.process,
+            'thread': record.threadName,
+            'file': record.filename,
+            'line': record.lineno,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class LogQueueHandler(QueueHandler):
+    '''
+    Puts records on the queue of a QueueListener thread, which formats and
+    writes them. Stock QueueHandler formats the whole record (traceback
+    included) in the calling thread, here only message arguments are merged
+    so they can't change before the record is written.
+    '''
+    def __init__(self, record_queue, listener):
+        super().__init__(record_queue)
+        self.listener = listener
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def set_log_format(log_format='text'):
+    for queue_handler in logger.handlers:
+        listener = getattr(queue_handler, 'listener', None)
+        if listener is None:
+            continue
+
+        for output in listener.handlers:
+            if log_format == 'json':
+                output.setFormatter(JsonFormatter())
+            elif isinstance(output, RotatingFileHandler):
+                output.setFormatter(file_formatter())
+            else:
+                output.setFormatter(default_formatter())
+    logger.info(f"Log format: {log_format}")
+
 def set_logger_level(level='info'):
     logger.info(f"Requested log level is: {level}")
     if level.lower() == 'info':
@@ -71,7 +129,7 @@ logger = logging.getLogger('kr_api_link_root')
 # If logger has no handlers, create default ones
 if not logger.handlers:
     # Basic logger setup
-    log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s(%(lineno)d) %(message)s')
+    log_formatter = file_formatter()
     logFile = VU_FileSystem.get_log_file_path()
 
     os.makedirs(os.path.dirname(logFile), exist_ok=True)
@@ -81,9 +139,13 @@ if not logger.handlers:
 
     # Shared stdout logger
     logger.setLevel(logging.INFO)
-    logger.addHandler(log_file_handler)
-    logger.setLevel(logging.INFO)
     logger.propagate = False
     handler = logging.StreamHandler(stream=sys.stderr)
     handler.setFormatter(default_formatter())
-    logger.addHandler(handler)
+
+    # File and console writes happen on listener thread, logging call only queues the record
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, log_file_handler, handler, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    logger.addHandler(LogQueueHandler(log_queue, log_listener))
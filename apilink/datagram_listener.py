@@ -0,0 +1,140 @@
+import os
+import math
+import socket
+import stat
+from tornado.ioloop import IOLoop, PeriodicCallback
+from apilink.base_logger import logger
+
+MAX_DATAGRAM_SIZE = 65535
+MAX_READS_PER_EVENT = 1000  # Leave room for other callbacks when flooded
+
+
+class DatagramListener:
+    '''
+    Receives values for push links over UDP and/or a Unix datagram socket.
+
+    Every datagram holds one or more `link_name:value` lines, where
+    `link_name` is link file name without `.toml`. Statsd style type suffix
+    (`|g`, `|c`, ...) is accepted and ignored. Values are only collected per
+    link while a window is open, once per `window` seconds each link gets
+    one value (aggregated as configured by its `aggregate` key) through the
+    regular modifier and dial pipeline.
+
+    Parsing runs on the IOLoop but costs one split and one float() per
+    line, link lookup and modifiers run only once per link and window.
+    '''
+    def __init__(self, link_manager, udp_port=0, udp_host='127.0.0.1', unix_path=None, window=1.0, max_links=10000):
+        # pylint: disable=too-many-arguments
+        self.link_manager = link_manager
+        self.udp_port = udp_port
+        self.udp_host = udp_host
+        self.unix_path = unix_path
+        self.window = max(0.01, float(window))
+        self.max_links = max_links
+        self.sockets = []
+        self.flusher = None
+        self.values = {}        # link name (bytes) -> [count, sum, max, last] in current window
+        self.lines = 0
+        self.errors = 0         # Malformed lines and values for unknown links
+
+    def start(self):
+        io_loop = IOLoop.current()
+        if self.udp_port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.udp_host, self.udp_port))
+            self._add_socket(io_loop, sock)
+            logger.info(f"Listening for link values on udp://{self.udp_host}:{self.udp_port}")
+
+        if self.unix_path:
+            if not hasattr(socket, 'AF_UNIX'):
+                logger.error("Unix domain sockets are not supported on this platform")
+            else:
+                # Socket file left behind by previous run
+                if os.path.exists(self.unix_path) and stat.S_ISSOCK(os.stat(self.unix_path).st_mode):
+                    os.remove(self.unix_path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)  # pylint: disable=no-member
+                sock.bind(self.unix_path)
+                self._add_socket(io_loop, sock)
+                logger.info(f"Listening for link values on unix://{self.unix_path}")
+
+        if self.sockets:
+            self.flusher = PeriodicCallback(self._flush, self.window * 1000)
+            self.flusher.start()
+
+    def _add_socket(self, io_loop, sock):
+        sock.setblocking(False)
+        io_loop.add_handler(sock.fileno(), lambda fd, events: self._on_readable(sock), IOLoop.READ)
+        self.sockets.append(sock)
+
+    def stop(self):
+        if self.flusher is not None:
+            self.flusher.stop()
+            self.flusher = None
+        io_loop = IOLoop.current()
+        for sock in self.sockets:
+            io_loop.remove_handler(sock.fileno())
+            sock.close()
+        self.sockets = []
+        if self.unix_path and os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+
+    def _on_readable(self, sock):
+        for _ in range(MAX_READS_PER_EVENT):
+            try:
+                data = sock.recv(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"Failed to read datagram: {e}")
+                return
+            self._parse(data)
+
+    def _parse(self, data):
+        values = self.values
+        for line in data.split(b'\n'):
+            name, separator, value = line.partition(b':')
+            name = name.strip()
+            if not separator:
+                if line.strip():
+                    self.errors += 1
+                continue
+
+            try:
+                value = float(value.split(b'|', 1)[0])
+            except ValueError:
+                self.errors += 1
+                continue
+            if not math.isfinite(value):
+                self.errors += 1
+                continue
+
+            self.lines += 1
+            window = values.get(name, None)
+            if window is None:
+                # Garbage names can not grow memory without bound
+                if len(values) >= self.max_links:
+                    self.errors += 1
+                    continue
+                values[name] = [1, value, value, value]
+                continue
+            window[0] += 1
+            window[1] += value
+            if value > window[2]:
+                window[2] = value
+            window[3] = value
+
+    def _flush(self):
+        values, self.values = self.values, {}
+        for name, (count, total, maximum, last) in values.items():
+            link_file = f"{name.decode('utf-8', errors='replace')}.toml"
+            link_driver = self.link_manager.links.get(link_file, None)
+            if link_driver is None or not link_driver.accepts_push:
+                self.errors += count
+                continue
+            if not link_driver.is_enabled():
+                continue
+
+            try:
+                link_driver.ingest_aggregate(count, total, maximum, last)
+            except Exception as e:
+                logger.error(f"Link `{link_file}` failed to process datagram values: {e}")
@@ -0,0 +1,79 @@
+import os
+import hashlib
+from collections import OrderedDict
+from tornado.ioloop import IOLoop
+
+
+class CachedFile:
+    __slots__ = ('path', 'data', 'digest', 'mtime', 'size')
+
+    def __init__(self, path, data, mtime, size):
+        self.path = path
+        self.data = data
+        self.digest = hashlib.sha1(data).hexdigest()
+        self.mtime = mtime
+        self.size = size
+
+
+class FileCache:
+    '''
+    In-memory LRU cache of file contents.
+
+    Entries are keyed by path and validated against file mtime and size on
+    every lookup, so changed files are picked up without explicit
+    invalidation. Total size of cached data is bounded by `max_bytes`,
+    least recently used files are dropped first.
+    '''
+    def __init__(self, max_bytes=16*1024*1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+
+    def _lookup(self, path):
+        # Raises OSError if file does not exist
+        stat = os.stat(path)
+        entry = self.entries.get(path, None)
+        if entry is not None and entry.mtime == stat.st_mtime_ns and entry.size == stat.st_size:
+            self.entries.move_to_end(path)
+            return entry, stat
+        return None, stat
+
+    @staticmethod
+    def _read(path):
+        with open(path, 'rb') as file:
+            return file.read()
+
+    def _store(self, path, data, stat):
+        entry = CachedFile(path, data, stat.st_mtime_ns, stat.st_size)
+        self.invalidate(path)
+
+        if entry.size <= self.max_bytes:
+            self.entries[path] = entry
+            self.total_bytes += entry.size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+        return entry
+
+    def get(self, path):
+        entry, stat = self._lookup(path)
+        if entry is None:
+            entry = self._store(path, self._read(path), stat)
+        return entry
+
+    async def get_async(self, path):
+        # Same as get() but cache misses are read on a worker thread
+        entry, stat = self._lookup(path)
+        if entry is None:
+            data = await IOLoop.current().run_in_executor(None, self._read, path)
+            entry = self._store(path, data, stat)
+        return entry
+
+    def invalidate(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+
+    def clear(self):
+        self.entries.clear()
+        self.total_bytes = 0
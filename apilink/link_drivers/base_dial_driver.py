@@ -1,13 +1,25 @@
 import os
-import requests
-from tornado.httpclient import AsyncHTTPClient
+import time
+import logging
+import uuid
+import asyncio
+from bisect import bisect_right
 from apilink.base_logger import logger
 from apilink.vu_filesystem import VU_FileSystem
+from apilink.file_cache import FileCache
+from apilink.link_drivers.http_client import http_client
+from apilink.metrics import Histogram
+
+# Image files shared by all dials, so the same PNG is read from disk only once
+image_cache = FileCache(max_bytes=8*1024*1024)
 
 class DialDriver:
-    def __init__(self, vu_dial_uid, vu_api_key, vu_host='localhost', vu_port=5340):
-        # pylint: disable=too-many-instance-attributes
-        self.http_client = AsyncHTTPClient()
+    def __init__(self, vu_dial_uid, vu_api_key, vu_host='localhost', vu_port=5340, connect_timeout=None, request_timeout=10,
+                 deadband=0, min_write_interval=0):
+        # pylint: disable=too-many-instance-attributes,too-many-arguments
+        self.http_client = http_client
+        self.connect_timeout = connect_timeout # None uses HTTP client default
+        self.request_timeout = request_timeout
         self.vu_dial_uid = vu_dial_uid
         self.vu_api_key = vu_api_key
         self.vu_host = vu_host
@@ -15,9 +27,19 @@ class DialDriver:
         self.current_percent = 0 # Last value sent to dial
         self.percent = 0 # Latest value
         self.image = 'img_blank.png'
+        self.current_image_digest = None # Content hash of last image sent to dial
         self.image_upload_pending = False
         self.backlight = { 'red': 0, 'green': 0, 'blue': 0 }
+        self.current_backlight = None # Last backlight sent to dial
         self.backlight_map = None
+        self.backlight_table = None # Backlight for every percent 0-100, None keeps previous color
+        self.update_seconds = Histogram()
+        self.update_errors = 0
+        self.deadband = deadband # Value changes smaller than this are not sent
+        self.min_write_interval = min_write_interval # Seconds between writes to the dial
+        self.last_write = None
+        self.writer = None # Running write loop, only one request batch is in flight per dial
+        self.closed = False
 
     def _make_url(self, handler, keyVal=None):
         url_parameters = ""
@@ -26,106 +48,227 @@ class DialDriver:
         return f"http://{self.vu_host}:{self.vu_port}/api/v0/dial/{self.vu_dial_uid}/{handler}?key={self.vu_api_key}{url_parameters}"
 
     async def _update_value(self):
-        response = await self.http_client.fetch(self._make_url('set', {'value': self.percent}), method='GET', request_timeout=10)
+        # Value can change while request is in flight, only what was sent counts as current
+        percent = self.percent
+        response = await self.http_client.fetch(self._make_url('set', {'value': percent}), method='GET',
+                                                connect_timeout=self.connect_timeout, request_timeout=self.request_timeout)
         if response.code == 200:
-            self.current_percent = self.percent
-            logger.debug(f"Dial `{self.vu_dial_uid}` updated to {self.percent}%")
+            self.current_percent = percent
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Dial `{self.vu_dial_uid}` updated to {percent}%")
             return True
 
         logger.error(f"Failed to update dial `{self.vu_dial_uid}`. Server status code {response.code}")
         return False
 
     async def _update_backlight(self):
+        backlight = dict(self.backlight)
         response = await self.http_client.fetch(
                                                 self._make_url('backlight',
                                                 {
-                                                    'red': self.backlight['red'],
-                                                    'green': self.backlight['green'],
-                                                    'blue': self.backlight['blue']
+                                                    'red': backlight['red'],
+                                                    'green': backlight['green'],
+                                                    'blue': backlight['blue']
                                                 }),
-                                                method='GET', request_timeout=10)
+                                                method='GET', connect_timeout=self.connect_timeout, request_timeout=self.request_timeout)
         if response.code  == 201:
-            logger.debug(f"Dial `{self.vu_dial_uid}` backlight updated to R:{self.backlight['red']} G:{self.backlight['green']} B:{self.backlight['blue']}")
+            self.current_backlight = backlight
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Dial `{self.vu_dial_uid}` backlight updated to R:{backlight['red']} G:{backlight['green']} B:{backlight['blue']}")
             return True
         if response.code  == 200:
-            logger.debug(f"Dial `{self.vu_dial_uid}` backlight is already at R:{self.backlight['red']} G:{self.backlight['green']} B:{self.backlight['blue']}")
+            self.current_backlight = backlight
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Dial `{self.vu_dial_uid}` backlight is already at R:{backlight['red']} G:{backlight['green']} B:{backlight['blue']}")
             return True
         logger.error(f"Failed to update dial `{self.vu_dial_uid}` backlight. Server status code {response.code}")
         return False
 
-    def _update_image(self):
-        if not self.image_upload_pending:
-            return True
+    def _make_image_body(self, image):
+        boundary = uuid.uuid4().hex
+        head = (f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="key"\r\n\r\n'
+                f'{self.vu_api_key}\r\n'
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="imgfile"; filename="{os.path.basename(image.path)}"\r\n'
+                f'Content-Type: image/png\r\n\r\n')
+        tail = f'\r\n--{boundary}--\r\n'
+        body = b''.join([head.encode('utf-8'), image.data, tail.encode('utf-8')])
+        return body, f'multipart/form-data; boundary={boundary}'
+
+    def _image_sent(self, image_name):
+        # New image set meanwhile stays pending
+        if self.image == image_name:
+            self.image_upload_pending = False
 
-        img_file = os.path.join(VU_FileSystem.get_link_images_folder_path(), self.image)
+    async def _update_image(self):
+        image_name = self.image
+        img_file = os.path.join(VU_FileSystem.get_link_images_folder_path(), image_name)
 
-        if not os.path.isfile(img_file):
+        try:
+            image = await image_cache.get_async(img_file)
+        except OSError:
             logger.error(f"Image `{img_file}` does not exist! Aborting.")
-            self.image_upload_pending = False
+            self._image_sent(image_name)
             return False
 
-        files = {'imgfile': open(img_file, 'rb'), 'key': self.vu_api_key}
-        response = requests.post(self._make_url('image/set'), files=files, timeout=10)
+        # Dial already shows this exact image
+        if image.digest == self.current_image_digest:
+            self._image_sent(image_name)
+            return True
 
-        if response.status_code == 201:
-            self.image_upload_pending = False
+        body, content_type = self._make_image_body(image)
+        response = await self.http_client.fetch(self._make_url('image/set'), method='POST', body=body,
+                                                headers={'Content-Type': content_type},
+                                                connect_timeout=self.connect_timeout, request_timeout=self.request_timeout)
+
+        if response.code == 201:
+            self._image_sent(image_name)
+            self.current_image_digest = image.digest
             logger.debug(f"Dial `{self.vu_dial_uid}` image updated")
             return True
-        if response.status_code == 200:
+        if response.code == 200:
+            self._image_sent(image_name)
+            self.current_image_digest = image.digest
             logger.debug(f"Dial `{self.vu_dial_uid}` is already at the correct image.")
             return True
 
-        logger.error(f"Failed to update dial `{self.vu_dial_uid}` image. Server status code {response.status_code}")
+        logger.error(f"Failed to update dial `{self.vu_dial_uid}` image. Server status code {response.code}")
         return False
 
+    @staticmethod
+    def _build_backlight_table(colormap, interpolate=False):
+        # Raises ValueError/TypeError/IndexError for malformed map
+        thresholds = sorted((int(value), [int(rgb[0]), int(rgb[1]), int(rgb[2])]) for value, rgb in colormap.items())
+        keys = [value for value, _ in thresholds]
+
+        table = []
+        for percent in range(101):
+            index = bisect_right(keys, percent) - 1
+            if index < 0:
+                table.append(None)
+                continue
+
+            value, rgb = thresholds[index]
+            if interpolate and index + 1 < len(thresholds):
+                # Blend towards the next threshold color
+                next_value, next_rgb = thresholds[index + 1]
+                ratio = (percent - value) / (next_value - value)
+                rgb = [round(start + (end - start) * ratio) for start, end in zip(rgb, next_rgb)]
+
+            table.append({ 'red': rgb[0], 'green': rgb[1], 'blue': rgb[2] })
+        return table
+
     def _recalculate_backlight(self):
-        if self.backlight_map is None:
+        if self.backlight_table is None:
             return False
 
-        # Then as we cross threshold, use that color
-        for value, rgb in self.backlight_map.items():
-            if self.percent >= int(value):
-                self.backlight['red'] = int(rgb[0])
-                self.backlight['green'] = int(rgb[1])
-                self.backlight['blue'] = int(rgb[2])
+        # Then as we cross threshold, use that color. Color follows value dial will show.
+        percent = self.percent if self._value_changed() else self.current_percent
+        backlight = self.backlight_table[min(max(percent, 0), 100)]
+        if backlight is not None:
+            self.backlight = backlight
         return True
 
     def set_dial_value(self, percent):
         self.percent = int(percent)
 
     def set_dial_image(self, image):
+        # Upload is skipped later if dial already has image with the same content
         self.image = image
         self.image_upload_pending = True
 
-    def set_backlight_map(self, colormap):
+    def set_backlight_map(self, colormap, interpolate=False):
+        self.backlight_table = self._build_backlight_table(colormap, interpolate)
         self.backlight_map = colormap
 
-    async def update(self):
-        # Is update necessary?
+    def _value_changed(self):
         if self.percent == self.current_percent:
-            return
+            return False
+        # Small changes are ignored, but dial can always reach either end of the scale
+        return abs(self.percent - self.current_percent) >= self.deadband or self.percent in (0, 100)
 
+    def _backlight_changed(self):
+        return self.backlight_map is not None and self.backlight != self.current_backlight
+
+    def is_up_to_date(self):
+        return not self._value_changed() and \
+               not self._backlight_changed() and \
+               not self.image_upload_pending
+
+    def close(self):
+        # Request already in flight still finishes, nothing new is sent
+        self.closed = True
+
+    def post_update(self):
+        '''
+        Hand latest state over to the dial writer without waiting for it.
+        Values set while a write is in flight are not queued, writer sends
+        whatever is latest once the dial is free again.
+        Returns the running writer or None if dial is already up to date.
+        '''
+        if self.writer is None and not self.closed:
+            self._recalculate_backlight()
+            if not self.is_up_to_date():
+                self.writer = asyncio.ensure_future(self._write_loop())
+        return self.writer
+
+    async def update(self):
+        # Post current state and wait until it reached the dial
+        writer = self.post_update()
+        if writer is None:
+            return True
+        return await writer
+
+    async def _write_loop(self):
+        result = True
         try:
-            # Update value
-            response = await self._update_value()
-            if not response:
-                logger.error("Failed to update dial value!")
-                return response
-
-            # Update backlight
-            if self._recalculate_backlight():
-                response = await self._update_backlight()
-                if not response:
-                    logger.error("Failed to update dial backlight!")
-                    return response
-
-            # Update image
-            response = self._update_image()
-            if not response:
-                logger.error("Failed to update dial image!")
-                return response
-
-            return response
-        except Exception as e:
-            logger.error(e)
-            return False
+            while not self.closed:
+                self._recalculate_backlight()
+
+                # Is update necessary?
+                if self.is_up_to_date():
+                    break
+
+                # Too soon after previous write, whatever is latest once interval passes gets sent
+                if self.min_write_interval > 0 and self.last_write is not None:
+                    wait = self.last_write + self.min_write_interval - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                        continue
+                self.last_write = time.monotonic()
+
+                # Failed write is retried once link posts again
+                result = await self._write()
+                if not result:
+                    break
+        finally:
+            self.writer = None
+        return result
+
+    async def _write(self):
+        # Only send what changed since the last update, independent commands go out together
+        commands = []
+        if self._value_changed():
+            commands.append(('value', self._update_value()))
+        if self._backlight_changed():
+            commands.append(('backlight', self._update_backlight()))
+        if self.image_upload_pending:
+            commands.append(('image', self._update_image()))
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*[command for _, command in commands], return_exceptions=True)
+        self.update_seconds.observe(time.perf_counter() - started)
+
+        response = True
+        for (name, _), result in zip(commands, results):
+            if isinstance(result, Exception):
+                logger.error(f"Failed to update dial {name}! {result}")
+                response = False
+            elif not result:
+                logger.error(f"Failed to update dial {name}!")
+                response = False
+
+        if not response:
+            self.update_errors += 1
+        return response
@@ -1,22 +1,53 @@
 import os
 import time
+import logging
+from functools import partial
 from tomlkit import dumps
 from tomlkit import parse
 from apilink.base_logger import logger
 from apilink.vu_filesystem import VU_FileSystem
 from apilink.link_drivers.base_dial_driver import DialDriver
 from apilink.link_drivers.value_modifiers import ValueModifiers
+from apilink.link_drivers.item_path import ItemPath, ItemPathError
+from apilink.link_drivers.config_writer import config_writer
+from apilink.link_drivers.config_loader import parse_link_config, get_content_digest
+from apilink.metrics import LinkMetrics
+from apilink.value_history import ValueHistory
+
+AVAILABLE_MODIFIERS = frozenset(func for func in dir(ValueModifiers) if callable(getattr(ValueModifiers, func)) and not func.startswith("_"))
 
 
 class BaseLinkDriver:
-    def __init__(self, cfg_file):
+    # Keys every config of this driver must have
+    required_keys = {
+        'info':  ['name', 'description'],
+        'api':  ['url', 'item', 'update_period'],
+        'dial':  ['uid', 'host', 'port', 'api_key'],
+    }
+    # Whether values can be pushed to the link through ingestion API
+    accepts_push = False
+    # Samples kept in value history unless link sets `history_size`, set by LinkManager
+    history_size = 1024
+
+    def __init__(self, cfg_file, cfg=None):
         # pylint: disable=too-many-instance-attributes
         self.ready = False
         self.dial_value = 0
         self.api_value = 0
+        self.raw_value = None   # Value before modifiers
         self.next_update = 0
         self.retry_delay = 60
         self.mod = ValueModifiers()
+        self.item_path = None
+        self.modifier_chain = []
+        self.volatile_modifiers = False
+        self.cfg_dirty = False
+        self.dial_driver = None
+        self.cfg_document = None    # tomlkit document, only parsed once config is edited
+        self.cfg_digest = None      # Digest of link file config was loaded from, set by LinkManager
+        self.cfg_outdated = False   # Document was parsed from a file edited after config was loaded
+        self.metrics = LinkMetrics()
+        self.history = ValueHistory(0)
 
         self.cfg = { 'info':{}, 'api':{} }
         self.cfg['info']['file'] = cfg_file
@@ -27,22 +58,57 @@ class BaseLinkDriver:
 
         self.cfg_file = cfg_file
 
-        if not self._load_config():
+        # Config might be already parsed by link loader
+        if not self._load_config(cfg):
+            return
+
+        # Optional throttling of dial writes
+        try:
+            deadband = float(self.cfg['dial'].get('deadband', 0))
+            min_write_interval = float(self.cfg['dial'].get('min_write_interval', 0))
+        except (TypeError, ValueError):
+            logger.error(f"Link file '{self.cfg_file}' `deadband` and `min_write_interval` must be numbers")
+            logger.error("This link will be ignored")
+            return
+
+        try:
+            self.history = ValueHistory(int(self.cfg['api'].get('history_size', self.history_size)))
+        except (TypeError, ValueError):
+            logger.error(f"Link file '{self.cfg_file}' `history_size` must be a number")
+            logger.error("This link will be ignored")
+            return
+
+        # Scheduler needs a usable period, checked once here instead of on every update
+        try:
+            update_period = self.get_update_period()
+        except (TypeError, ValueError):
+            update_period = 0
+        if update_period <= 0:
+            logger.error(f"Link file '{self.cfg_file}' `update_period` must be a positive number of seconds")
+            logger.error("This link will be ignored")
             return
 
         self.dial_driver = DialDriver( vu_dial_uid=self.cfg['dial']['uid'],
                                        vu_api_key=self.cfg['dial']['api_key'],
                                        vu_host=self.cfg['dial']['host'],
-                                       vu_port=self.cfg['dial']['port'] )
-
-        self.available_modifiers = [func for func in dir(self.mod) if callable(getattr(ValueModifiers, func)) and not func.startswith("__")]
+                                       vu_port=self.cfg['dial']['port'],
+                                       connect_timeout=self.cfg['dial'].get('connect_timeout', None),
+                                       request_timeout=self.cfg['dial'].get('request_timeout', 10),
+                                       deadband=deadband,
+                                       min_write_interval=min_write_interval )
 
-        if self.cfg['info']['image'] is not None:
+        if self.cfg['info'].get('image', None) is not None:
             self.set_dial_image(self.cfg['info']['image'])
 
         if self.cfg.get('backlight_map', None) is not None:
             logger.debug(f"Applying backlight map: {self.cfg['backlight_map']}")
-            self.dial_driver.set_backlight_map(self.cfg['backlight_map'])
+            try:
+                self.dial_driver.set_backlight_map(self.cfg['backlight_map'],
+                                                   interpolate=bool(self.cfg['dial'].get('backlight_gradient', False)))
+            except (ValueError, TypeError, IndexError) as e:
+                logger.error(f"Link file '{self.cfg_file}' has invalid `backlight_map`: {e}")
+                logger.error("This link will be ignored")
+                return
 
         self.ready = True
 
@@ -51,31 +117,31 @@ class BaseLinkDriver:
             return True
         return False
 
-    def _load_config(self):
-        filepath = os.path.join(VU_FileSystem.get_links_folder_path(), self.cfg_file)
-        if not os.path.exists(filepath):
-            logger.error(f"Can not load link '{self.cfg_file}'. Config file '{filepath}' does not exist!")
-            return None
-
-        with open(filepath, 'r', encoding="utf-8") as file:
-            cfg = file.read()  # pylint: disable=assignment-from-no-return
-
+    def _get_config_path(self):
+        return os.path.join(VU_FileSystem.get_links_folder_path(), self.cfg_file)
 
+    def _load_config(self, cfg=None):
         if cfg is None:
-            logger.error(f"Link file for '{self.cfg_file}' is empty or corrupt.")
-            return None
+            filepath = self._get_config_path()
+            if not os.path.exists(filepath):
+                logger.error(f"Can not load link '{self.cfg_file}'. Config file '{filepath}' does not exist!")
+                return None
+
+            with open(filepath, 'r', encoding="utf-8") as file:
+                content = file.read()
 
-        # Parse TOML file
-        cfg = parse(cfg)
+            # Parse TOML file, read-only copy is enough until config is edited
+            try:
+                cfg = parse_link_config(content)
+            except ValueError as e:
+                logger.error(f"Link file for '{self.cfg_file}' is empty or corrupt. {e}")
+                logger.error("This link will be ignored")
+                return None
 
-        # Define required keys every config must have
-        required_keys = {
-            'info':  ['name', 'description'],
-            'api':  ['url', 'item', 'update_period'],
-            'dial':  ['uid', 'host', 'port', 'api_key'],
-        }
+        required_keys = self.required_keys
 
-        logger.debug(cfg)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(cfg)
 
         # Check top-level keys
         if not self._check_keys_exist(required_keys.keys(), cfg):
@@ -89,21 +155,82 @@ class BaseLinkDriver:
                 logger.error("This link will be ignored")
                 return None
 
+        # Compile item expression once, it is used on every update
+        try:
+            if 'item' in cfg['api']:
+                self.item_path = ItemPath(cfg['api']['item'])
+        except ItemPathError as e:
+            logger.error(f"Link file '{self.cfg_file}' has invalid `item`: {e}")
+            logger.error("This link will be ignored")
+            return None
+
+        # Compile value modifiers once, unknown modifiers are rejected up front
+        try:
+            self.modifier_chain = self._compile_modifiers(cfg['api'].get('value_modifiers', []))
+        except ValueError as e:
+            logger.error(f"Link file '{self.cfg_file}' has invalid `value_modifiers`: {e}")
+            logger.error("This link will be ignored")
+            return None
+        self.volatile_modifiers = any(modifier.get('function', None) in ValueModifiers.volatile_modifiers
+                                      for modifier in cfg['api'].get('value_modifiers', []))
+
         # Update class cfg
         self.cfg = cfg
 
         return True
 
     def save_config(self):
-        filepath = os.path.join(VU_FileSystem.get_links_folder_path(), self.cfg_file)
+        # Queue write-behind save, nothing to do if config did not change
+        if self.cfg_dirty:
+            config_writer.schedule(self)
+        return True
+
+    async def flush_config(self):
+        self.save_config()
+        await config_writer.flush()
+        return True
 
-        with open(filepath, 'w', encoding='utf-8') as file:
-            file.write(dumps(self.cfg))
+    def mark_config_dirty(self):
+        # Never write back config of a link that failed to load
+        if not self.ready:
+            return
+        self.cfg_dirty = True
+        self.save_config()
+
+    def set_config_value(self, section, key, value):
+        if self.cfg[section].get(key, None) == value:
+            return False
+        self.cfg[section][key] = value
+
+        # Keep editable document in sync, it is what gets saved
+        if self.ready:
+            self._get_document()[section][key] = value
+        self.mark_config_dirty()
         return True
 
+    def _get_document(self):
+        # Formatting and comments of link file are preserved when config is saved
+        if self.cfg_document is None:
+            with open(self._get_config_path(), 'r', encoding="utf-8") as file:
+                content = file.read()
+            # Edits made to the file since loading are kept when saving, link has to be reloaded to use them
+            if self.cfg_digest is not None and get_content_digest(content.encode('utf-8')) != self.cfg_digest:
+                self.cfg_outdated = True
+            self.cfg_document = parse(content)
+        return self.cfg_document
+
+    def is_config_edited(self):
+        return self.cfg_document is not None
+
+    def is_config_outdated(self):
+        return self.cfg_outdated
+
+    def dump_config(self):
+        return dumps(self._get_document())
+
     def get_config(self, raw=False):
         if raw:
-            return dumps(self.cfg)
+            return self.dump_config()
         return self.cfg
 
     def get_headers(self):
@@ -119,18 +246,21 @@ class BaseLinkDriver:
     def get_next_update(self):
         return self.next_update
 
+    def get_update_period(self):
+        return int(self.cfg['api']['update_period'])
+
     def is_enabled(self):
-        return self.cfg['info']['enabled']
+        return self.cfg['info'].get('enabled', True)
 
-    def enable(self):
-        self.cfg['info']['enabled'] = True
-        self.save_config()
+    async def enable(self):
+        self.set_config_value('info', 'enabled', True)
+        await self.flush_config()
         self.next_update = time.time()
         return True
 
     async def disable(self):
-        self.cfg['info']['enabled'] = False
-        self.save_config()
+        self.set_config_value('info', 'enabled', False)
+        await self.flush_config()
         self.set_dial_value(0)
         await self.dial_driver.update()
         return True
@@ -150,6 +280,11 @@ class BaseLinkDriver:
     def fetch(self):
         raise NotImplementedError
 
+    def close(self):
+        # Release shared resources held by the driver, called when link is unloaded
+        if self.dial_driver is not None:
+            self.dial_driver.close()
+
     async def update(self):
         raise NotImplementedError
 
@@ -160,23 +295,64 @@ class BaseLinkDriver:
         self.dial_driver.set_dial_image(image)
 
 
-    def apply_modifiers(self):
-        mod_list = self.cfg['api'].get('value_modifiers', [])
-        if len(mod_list) <= 0:
-            return
+    def has_volatile_modifiers(self):
+        return self.volatile_modifiers
 
+    def _compile_modifiers(self, mod_list):
+        chain = []
         for modifier in mod_list:
-            function_name = modifier.get('function', None)
+            function_name = str(modifier.get('function', None))
+            if function_name not in AVAILABLE_MODIFIERS:
+                raise ValueError(f"Requested modifier `{function_name}` does not exist.")
 
-            if str(function_name) not in self.available_modifiers:
-                logger.error(f"Requested modifier {function_name} does not exist.")
-                break
+            # Plain python values instead of tomlkit items, numeric arguments converted up front
+            args = {str(key): value.unwrap() if hasattr(value, 'unwrap') else value for key, value in modifier.items()}
+            for key, cast in ValueModifiers.argument_types.get(function_name, {}).items():
+                if key in args:
+                    try:
+                        args[key] = cast(args[key])
+                    except (TypeError, ValueError):
+                        raise ValueError(f"Modifier `{function_name}` argument `{key}` must be a number, got `{args[key]}`") from None
 
-            # Call modifier function
-            logger.debug(f"Applying modifier function `{function_name}`")
-            func = getattr(self.mod, function_name)
-            self.api_value = func( value=self.api_value, args=modifier )
+            chain.append(partial(getattr(self.mod, function_name), args=args))
 
         # Always apply sanity check
-        logger.debug("Applying modifier function `value_clip`")
-        self.api_value = self.mod.value_clip(value=self.api_value, args={})
+        if chain:
+            chain.append(partial(self.mod.value_clip, args={}))
+        return chain
+
+    def apply_modifiers(self):
+        started = time.perf_counter()
+        value = self.api_value
+        for func in self.modifier_chain:
+            value = func(value=value)
+        self.api_value = value
+        self.metrics.modifier_seconds.observe(time.perf_counter() - started)
+
+    def ingest_value(self, value):
+        '''
+        Run value through modifier chain and hand result over to dial writer.
+        Used for values the link did not fetch itself (streams, pushes).
+        '''
+        self.raw_value = value
+        self.api_value = value
+        self.apply_modifiers()
+        self.set_dial_value(self.api_value)
+        self.record_value()
+        self.metrics.last_success = time.time()
+        self.dial_driver.post_update()
+
+    def record_value(self):
+        self.history.append(time.time(), self.raw_value, self.api_value)
+
+    def get_history(self, since=0.0, step=None):
+        if step:
+            return self.history.get_buckets(step, since)
+        return self.history.get_points(since)
+
+    def get_metrics(self):
+        metrics = self.metrics.to_dict()
+        metrics['dial'] = self.cfg['dial']['uid']
+        metrics['dial_seconds'] = self.dial_driver.update_seconds.to_dict()
+        metrics['dial_errors'] = self.dial_driver.update_errors
+        return metrics
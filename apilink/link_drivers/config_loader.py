@@ -0,0 +1,148 @@
+import os
+import copy
+import json
+import hashlib
+import tempfile
+from tomlkit import parse
+
+# Fast read-only parser, tomlkit round-trip parser is only needed once a config is edited
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# Mode `open()` gives new files, read once at import as umask can only be read by changing it
+NEW_FILE_MODE = 0o666 & ~_get_umask()
+
+
+def parse_link_config(content):
+    # Raises ValueError for invalid TOML, returns plain python types
+    if tomllib is not None:
+        return tomllib.loads(content)
+    return parse(content).unwrap()
+
+
+def get_content_digest(data):
+    # Line endings are normalized so config saved by the link itself hashes the same on every platform
+    return hashlib.sha1(data.replace(b'\r\n', b'\n')).hexdigest()
+
+
+def replace_file(temp_path, filepath):
+    # mkstemp creates files as 0600, replaced file keeps the mode it had
+    try:
+        mode = os.stat(filepath).st_mode
+    except FileNotFoundError:
+        mode = NEW_FILE_MODE
+    os.chmod(temp_path, mode & 0o7777)
+    os.replace(temp_path, filepath)
+
+
+def read_file_signature(filepath):
+    stat = os.stat(filepath)
+    with open(filepath, 'rb') as file:
+        digest = get_content_digest(file.read())
+    return (stat.st_mtime_ns, stat.st_size, digest)
+
+
+class LinkConfigCache:
+    '''
+    Validated link configs from previous runs, stored as JSON next to the
+    links folder.
+
+    Entries are keyed by link file and only used while file mtime and size
+    are the same as when the entry was stored, so unchanged links skip TOML
+    parsing on startup. Configs with values JSON can't hold (TOML dates) are
+    not cached. Lookups run on loader threads, writes only on the IOLoop.
+    '''
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                content = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        if isinstance(content, dict) and content.get('version', None) == self.VERSION:
+            self.entries = content.get('links', {})
+
+    def get(self, link_file, stat):
+        entry = self.entries.get(link_file, None)
+        if entry is None or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        # Drivers change their config, cached copy has to stay as it was on disk
+        return copy.deepcopy(entry['config']), (entry['mtime'], entry['size'], entry['digest'])
+
+    @staticmethod
+    def make_snapshot(cfg):
+        try:
+            return json.loads(json.dumps(cfg))
+        except (TypeError, ValueError):
+            return None
+
+    def put(self, link_file, signature, snapshot):
+        mtime, size, digest = signature
+        self.entries[link_file] = {'mtime': mtime, 'size': size, 'digest': digest, 'config': snapshot}
+        self.dirty = True
+
+    def retain(self, link_files):
+        # Drop entries of links that are gone or failed to load
+        for link_file in list(self.entries):
+            if link_file not in link_files:
+                del self.entries[link_file]
+                self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        content = json.dumps({'version': self.VERSION, 'links': self.entries})
+        self.dirty = False
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=f'.{os.path.basename(self.path)}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(content)
+            replace_file(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def read_link_config(filepath, link_file, cache=None):
+    '''
+    Read and parse link file, meant to run on a worker thread.
+    Returns (cfg, signature, snapshot) where snapshot is JSON safe copy for
+    the cache (None when config came from cache or can't be cached).
+    Returns None if file can't be read or parsed, driver then loads it
+    itself and reports the error.
+    '''
+    try:
+        stat = os.stat(filepath)
+        if cache is not None:
+            cached = cache.get(link_file, stat)
+            if cached is not None:
+                return cached[0], cached[1], None
+
+        with open(filepath, 'rb') as file:
+            data = file.read()
+        cfg = parse_link_config(data.decode('utf-8'))
+    except (OSError, ValueError):
+        return None
+
+    signature = (stat.st_mtime_ns, stat.st_size, get_content_digest(data))
+    return cfg, signature, LinkConfigCache.make_snapshot(cfg)
@@ -0,0 +1,84 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop
+from apilink.base_logger import logger
+from apilink.vu_filesystem import VU_FileSystem
+from apilink.link_drivers.config_loader import replace_file
+
+
+class ConfigWriter:
+    '''
+    Write-behind persistence for link config files.
+
+    Drivers mark their config as dirty and the writer saves all dirty configs
+    in one batch after `flush_delay` seconds. Serialization happens on the
+    IOLoop (tomlkit documents are not thread safe), file writes run on a single
+    worker thread so they never block the loop and always land in order.
+    Files are replaced atomically (temp file + rename).
+    '''
+    def __init__(self, flush_delay=2.0):
+        self.flush_delay = flush_delay
+        self.pending = {}   # cfg_file -> driver
+        self.timeout = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='config_writer')
+
+    def schedule(self, driver):
+        self.pending[driver.cfg_file] = driver
+        if self.timeout is None:
+            self.timeout = IOLoop.current().call_later(self.flush_delay, self._flush_callback)
+
+    def discard(self, cfg_file):
+        self.pending.pop(cfg_file, None)
+
+    def _take_pending(self):
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+        batch = {}
+        for cfg_file, driver in self.pending.items():
+            batch[cfg_file] = driver.dump_config()
+            driver.cfg_dirty = False
+        self.pending.clear()
+        return batch
+
+    def _flush_callback(self):
+        self.timeout = None
+        IOLoop.current().spawn_callback(self.flush)
+
+    async def flush(self):
+        batch = self._take_pending()
+        if batch:
+            await IOLoop.current().run_in_executor(self.executor, self._write_batch, batch)
+
+    def flush_sync(self):
+        # Used on shutdown when IOLoop might not run anymore
+        batch = self._take_pending()
+        self.executor.submit(self._write_batch, batch).result()
+
+    def _write_batch(self, batch):
+        for cfg_file, content in batch.items():
+            filepath = os.path.join(VU_FileSystem.get_links_folder_path(), cfg_file)
+            try:
+                self._write_atomic(filepath, content)
+                logger.debug(f"Saved link config `{filepath}`")
+            except OSError as e:
+                logger.error(f"Failed to save link config `{filepath}`: {e}")
+
+    @staticmethod
+    def _write_atomic(filepath, content):
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=f'.{os.path.basename(filepath)}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            replace_file(temp_path, filepath)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+config_writer = ConfigWriter()
@@ -0,0 +1,178 @@
+import math
+import time
+import logging
+from tornado.ioloop import IOLoop
+from apilink.link_drivers.base_link_driver import BaseLinkDriver
+from apilink.base_logger import logger
+
+# How values received by datagram listener within one window are combined
+AGGREGATES = ('last', 'avg', 'max', 'sum')
+
+
+class TokenBucket:
+    '''
+    Allows `rate` events per second on average and bursts of up to `burst`
+    events. Rate of 0 means no limit.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        if not self.rate:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def get_wait(self):
+        # Seconds until next event is allowed
+        if not self.rate:
+            return 0.0
+        return max(0.0, (1 - self.tokens) / self.rate - (time.monotonic() - self.updated))
+
+
+class Driver_Push(BaseLinkDriver):
+    '''
+    Link that never fetches, producers push values to it through
+    `/api/v0/link/push`. Pushed values go through modifier chain to the dial
+    writer right away.
+
+    `max_push_rate` limits accepted values per second (default 10, 0 for no
+    limit) with bursts of up to `push_burst` values. Pushes over the limit
+    are reported as rate limited, the latest of them is kept and applied
+    once the limit allows it so the dial always ends on the newest value.
+    `update_period` (default 60) is how often dial state that failed to
+    reach the dial is re-sent.
+
+    Values sent to datagram listener are not rate limited, they arrive once
+    per window combined by `aggregate` (`last`, `avg`, `max` or `sum`).
+    '''
+    required_keys = {
+        'info':  ['name', 'description'],
+        'api':  [],
+        'dial':  ['uid', 'host', 'port', 'api_key'],
+    }
+    accepts_push = True
+
+    def __init__(self, cfg_file, cfg=None):
+        super().__init__(cfg_file, cfg)
+        self.cfg['info']['driver'] = 'push'
+        self.rate_limit = None
+        self.aggregate = 'last'
+        self.pushes = 0
+        self.pushes_rejected = 0
+        self.pending_value = None
+        self.pending_timeout = None
+
+        if not self.is_ready():
+            return
+
+        try:
+            rate = max(0.0, float(self.cfg['api'].get('max_push_rate', 10)))
+            burst = max(1.0, float(self.cfg['api'].get('push_burst', rate)))
+        except (TypeError, ValueError):
+            logger.error(f"Link file '{self.cfg_file}' `max_push_rate` and `push_burst` must be numbers")
+            logger.error("This link will be ignored")
+            self.ready = False
+            return
+        self.rate_limit = TokenBucket(rate, burst)
+
+        self.aggregate = self.cfg['api'].get('aggregate', 'last')
+        if self.aggregate not in AGGREGATES:
+            logger.error(f"Link file '{self.cfg_file}' has unknown `aggregate` `{self.aggregate}`, expected one of {AGGREGATES}")
+            logger.error("This link will be ignored")
+            self.ready = False
+
+    def get_update_period(self):
+        return int(self.cfg['api'].get('update_period', 60))
+
+    def close(self):
+        super().close()
+        self._cancel_pending()
+
+    async def disable(self):
+        self._cancel_pending()
+        return await super().disable()
+
+    def _cancel_pending(self):
+        if self.pending_timeout is not None:
+            IOLoop.current().remove_timeout(self.pending_timeout)
+            self.pending_timeout = None
+
+    async def update(self) -> None:
+        # Values are pushed, periodic update only re-sends dial state
+        self.dial_driver.post_update()
+        self.next_update = time.time() + self.get_update_period()
+        return True
+
+    def push_value(self, value):
+        '''
+        Accept value from a producer. Returns False if it was rejected by
+        rate limit, raises ValueError if value is not a number.
+        '''
+        value = float(value)
+        if not math.isfinite(value):
+            raise ValueError(f"Value `{value}` is not a finite number")
+
+        if not self.rate_limit.take():
+            # Only the latest throttled value is kept, it is applied once a token frees up
+            self.pushes_rejected += 1
+            self.pending_value = value
+            if self.pending_timeout is None:
+                self.pending_timeout = IOLoop.current().call_later(self.rate_limit.get_wait(), self._apply_pending)
+            return False
+
+        # Newer value replaces the one waiting for the limit
+        self._cancel_pending()
+        self.pushes += 1
+        self.ingest_value(value)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Pushed value: {value}, final value: {self.api_value}")
+        return True
+
+    def _apply_pending(self):
+        self.pending_timeout = None
+        if not self.rate_limit.take():
+            self.pending_timeout = IOLoop.current().call_later(self.rate_limit.get_wait(), self._apply_pending)
+            return
+
+        try:
+            self.ingest_value(self.pending_value)
+        except Exception as e:
+            self.metrics.errors += 1
+            logger.error(f"Link '{self.get_name()}' failed to process value `{self.pending_value}`: {e}")
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Throttled value: {self.pending_value}, final value: {self.api_value}")
+
+    def ingest_aggregate(self, count, total, maximum, last):
+        # One window of datagram values
+        if self.aggregate == 'avg':
+            value = total / count
+        elif self.aggregate == 'max':
+            value = maximum
+        elif self.aggregate == 'sum':
+            value = total
+        else:
+            value = last
+
+        self._cancel_pending()
+        self.pushes += count
+        self.ingest_value(value)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Aggregated {count} values to {value}, final value: {self.api_value}")
+
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        metrics['pushes'] = self.pushes
+        metrics['pushes_rejected'] = self.pushes_rejected
+        return metrics
@@ -1,49 +1,162 @@
+import logging
 import time
 import json
-from tornado.httpclient import AsyncHTTPClient
 from apilink.link_drivers.base_link_driver import BaseLinkDriver
+from apilink.link_drivers.item_path import ItemPathError
+from apilink.link_drivers.response_cache import response_cache, NOT_MODIFIED
+from apilink.link_drivers.http_client import http_client
+from apilink.link_drivers.json_stream import JsonItemScanner, ResponseReader, ItemFound
 from apilink.base_logger import logger
 
 class Driver_Requests(BaseLinkDriver):
-    def __init__(self, cfg_file):
-        super().__init__(cfg_file)
+    def __init__(self, cfg_file, cfg=None):
+        super().__init__(cfg_file, cfg)
         self.cfg['info']['driver'] = 'requests'
-        self.http_client = AsyncHTTPClient()
+        self.http_client = http_client
+        self.cache_key = None
+        self.response_version = None  # Version of cached response this link last processed
+        self.streaming = False
+        self.max_body_size = 0
+        self.connect_timeout = None
+        self.request_timeout = None
 
-    async def update(self) -> None:
-        if time.time() >= self.next_update:
+        if not self.is_ready():
+            return
+
+        # Streaming mode parses response as it arrives and stops once item is found
+        self.streaming = bool(self.cfg['api'].get('streaming', False))
+        try:
+            self.max_body_size = int(self.cfg['api'].get('max_body_size', 0))
+        except (TypeError, ValueError):
+            logger.error(f"Link file '{self.cfg_file}' `max_body_size` must be a number")
+            logger.error("This link will be ignored")
+            self.ready = False
+            return
+        # None uses HTTP client default
+        self.connect_timeout = self.cfg['api'].get('connect_timeout', None)
+        self.request_timeout = self.cfg['api'].get('request_timeout', None)
+        if self.streaming and any(isinstance(key, int) and key < 0 for key in self.item_path.keys):
+            logger.error(f"Link file '{self.cfg_file}' uses negative index in `item`, it can not be used with `streaming`")
+            logger.error("This link will be ignored")
+            self.ready = False
+            return
+
+        # Links polling the same URL with the same headers share one response.
+        # Streaming links only get their own item, so item is part of the key.
+        variant = self.item_path.keys if self.streaming else None
+        self.cache_key = response_cache.make_key(self.cfg['api']['url'], self.get_headers(), variant)
+        response_cache.register(self.cache_key, self, self.get_update_period())
+
+    def close(self):
+        super().close()
+        if self.cache_key is not None:
+            response_cache.unregister(self.cache_key, self)
+            self.cache_key = None
+
+    async def _fetch(self, previous):
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f"Fetching '{self.cfg['api']['url']}'")
 
-            headers = self.get_headers()
+        # Ask upstream to skip the body if nothing changed since last response
+        headers = dict(self.get_headers() or {})
+        if previous is not None:
+            if previous.etag is not None:
+                headers['If-None-Match'] = previous.etag
+            if previous.last_modified is not None:
+                headers['If-Modified-Since'] = previous.last_modified
+
+        # Plain fetch unless response has to be size capped or scanned as it arrives
+        reader = None
+        options = {}
+        if self.streaming or self.max_body_size > 0:
+            reader = ResponseReader(self.max_body_size, JsonItemScanner(self.item_path.keys) if self.streaming else None)
+            options = {'header_callback': reader.on_header, 'streaming_callback': reader.on_chunk}
+
+        started = time.perf_counter()
+        try:
+            client = await self.http_client.fetch(self.cfg['api']['url'], headers=headers, raise_error=False,
+                                                  connect_timeout=self.connect_timeout, request_timeout=self.request_timeout, **options)
+        except Exception:
+            # Transfer stopped by the reader shows up as closed connection
+            if reader is None or reader.aborted is None:
+                raise
+            client = None
+        finally:
+            self.metrics.fetch_seconds.observe(time.perf_counter() - started)
 
-            client = await self.http_client.fetch(request=self.cfg['api']['url'], headers=headers)
-            response = json.loads(client.body.decode(errors="ignore"))
+        # curl client can not be stopped from the callback, it finishes transfer with reader ignoring the rest
+        if reader is not None and reader.aborted is not None:
+            if not isinstance(reader.aborted, ItemFound):
+                raise reader.aborted
+            logger.debug(f"Found target item in '{self.cfg['api']['url']}' after {reader.size} bytes")
+            return reader.scanner.value, reader.headers.get('ETag', None), reader.headers.get('Last-Modified', None)
 
+        if client.code == 304 and previous is not None:
+            logger.debug(f"'{self.cfg['api']['url']}' not modified")
+            return NOT_MODIFIED, previous.etag, previous.last_modified
+        client.rethrow()
+
+        started = time.perf_counter()
+        if reader is None:
+            payload = json.loads(client.body.decode(errors="ignore"))
+        elif self.streaming:
+            payload = reader.scanner.finish()
+        else:
+            payload = json.loads(reader.get_body().decode(errors="ignore"))
+        self.metrics.parse_seconds.observe(time.perf_counter() - started)
+        return payload, client.headers.get('ETag', None), client.headers.get('Last-Modified', None)
+
+    async def update(self) -> None:
+        if time.time() >= self.next_update:
             try:
-                self.api_value = eval(self.cfg['api']['item'])
-                logger.debug(f"API response: '{response}'")
-                logger.debug(f"Found target item `{self.cfg['api']['item']}`. Value: {self.api_value}")
-            except KeyError:
-                logger.error("API request did not contain item specified in the config!")
+                entry = await response_cache.get(self.cache_key, self._fetch)
+
+                # Same response as last time, value can only change if modifiers depend on current time
+                if entry.version == self.response_version and not self.has_volatile_modifiers():
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"Response for '{self.cfg['api']['url']}' unchanged, keeping value {self.api_value}")
+                    self.record_value()
+                    self.dial_driver.post_update()
+                    self.next_update = time.time() + int(self.cfg['api']['update_period'])
+                    return True
+
+                response = entry.payload
+
+                # Streaming links cache the item itself
+                if self.streaming:
+                    self.api_value = response
+                else:
+                    started = time.perf_counter()
+                    self.api_value = self.item_path.resolve(response)
+                    self.metrics.eval_seconds.observe(time.perf_counter() - started)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"API response: '{response}'")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Found target item `{self.cfg['api']['item']}`. Value: {self.api_value}")
+            except ItemPathError as e:
+                logger.error(f"API request did not contain item specified in the config! {e}")
                 logger.error(f"API:'{self.cfg['api']['url']}' Item:'{self.cfg['api']['item']}')")
                 return False
 
             # 0. API value
-            logger.debug(f"API value: {self.api_value}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"API value: {self.api_value}")
 
             # 1. Run modifiers (if required)
+            self.raw_value = self.api_value
             self.apply_modifiers()
+            self.record_value()
 
             # 2. Update dial value
             self.set_dial_value(self.api_value)
+            # Only a response that produced a value counts as processed, broken item is reported again on next update
+            self.response_version = entry.version
 
-            # 3. Propagate changes by calling .update() on dial driver
-            logger.debug(f"Final value: {self.api_value}")
-            await self.dial_driver.update()
+            # 3. Hand value over to dial writer, slow VU server does not hold back polling
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Final value: {self.api_value}")
+            self.dial_driver.post_update()
 
             # Mark that we actually updated the API call
             self.next_update = time.time() + int(self.cfg['api']['update_period'])
-
-            # Update any new/values that have been added to the config to survive restart
-            self.save_config()
             return True
@@ -0,0 +1,280 @@
+import json
+import time
+import random
+import asyncio
+import logging
+from urllib.parse import urlsplit
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+from apilink.link_drivers.base_link_driver import BaseLinkDriver
+from apilink.link_drivers.item_path import ItemPathError
+from apilink.link_drivers.json_stream import StreamAbort
+from apilink.base_logger import logger
+
+STREAM_PROTOCOLS = ('websocket', 'sse')
+
+
+class StreamClosed(StreamAbort):
+    pass
+
+
+class ServerSentEvents:
+    '''
+    Incremental parser for `text/event-stream` bodies. Chunks can split lines
+    anywhere, complete events are returned as (event, data, id) once their
+    closing blank line arrives.
+    '''
+    def __init__(self):
+        self.buffer = b''
+        self.data = []
+        self.event = None
+        self.last_id = None
+        self.retry = None   # Reconnect delay requested by server, in seconds
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        lines = self.buffer.replace(b'\r\n', b'\n').replace(b'\r', b'\n').split(b'\n')
+        self.buffer = lines.pop()
+
+        events = []
+        for line in lines:
+            if not line:
+                if self.data:
+                    events.append((self.event or 'message', '\n'.join(self.data), self.last_id))
+                self.data = []
+                self.event = None
+                continue
+
+            # Lines starting with colon are comments, servers use them as keep-alive
+            field, _, value = line.decode('utf-8', errors='replace').partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if field == 'data':
+                self.data.append(value)
+            elif field == 'event':
+                self.event = value
+            elif field == 'id':
+                self.last_id = value
+            elif field == 'retry' and value.isdigit():
+                self.retry = int(value) / 1000
+        return events
+
+
+class Driver_Stream(BaseLinkDriver):
+    '''
+    Link fed by a persistent WebSocket (`ws://`, `wss://`) or Server-Sent
+    Events (`http://`, `https://`) connection instead of polling.
+
+    Every message is decoded as JSON and `item` is looked up in it. Modifiers
+    and dial update only run when the value changed, at most once every
+    `min_update_interval` seconds; values arriving faster than that are
+    dropped except for the latest one. Lost connections are re-opened with
+    exponential backoff between `reconnect_delay` and `max_reconnect_delay`.
+
+    `update_period` is how often the scheduler checks the connection is
+    running and re-sends dial state that failed to reach the dial.
+    '''
+    def __init__(self, cfg_file, cfg=None):
+        # pylint: disable=too-many-instance-attributes
+        super().__init__(cfg_file, cfg)
+        self.cfg['info']['driver'] = 'stream'
+        self.protocol = None
+        self.min_update_interval = 0.0
+        self.reconnect_delay = 1.0
+        self.max_reconnect_delay = 60.0
+        self.ping_interval = 30.0
+        self.connect_timeout = None
+        self.stream_task = None
+        self.connection = None  # Open WebSocket, SSE transfer is stopped from its streaming callback
+        self.closed = False
+        self.connected = False
+        self.reconnects = 0
+        self.last_event_id = None
+        self.pending_value = None
+        self.pending_timeout = None
+        self.last_applied = 0.0
+
+        if not self.is_ready():
+            return
+
+        url = self.cfg['api']['url']
+        scheme = urlsplit(url).scheme.lower()
+        self.protocol = self.cfg['api'].get('protocol', 'websocket' if scheme in ('ws', 'wss') else 'sse')
+        if self.protocol not in STREAM_PROTOCOLS:
+            logger.error(f"Link file '{self.cfg_file}' has unknown `protocol` `{self.protocol}`, expected one of {STREAM_PROTOCOLS}")
+            logger.error("This link will be ignored")
+            self.ready = False
+            return
+
+        try:
+            self.min_update_interval = max(0.0, float(self.cfg['api'].get('min_update_interval', 0.1)))
+            self.reconnect_delay = max(0.1, float(self.cfg['api'].get('reconnect_delay', 1.0)))
+            self.max_reconnect_delay = max(self.reconnect_delay, float(self.cfg['api'].get('max_reconnect_delay', 60.0)))
+            self.ping_interval = max(0.0, float(self.cfg['api'].get('ping_interval', 30.0)))
+            self.connect_timeout = float(self.cfg['api'].get('connect_timeout', 20.0))
+        except (TypeError, ValueError):
+            logger.error(f"Link file '{self.cfg_file}' stream options must be numbers")
+            logger.error("This link will be ignored")
+            self.ready = False
+            return
+
+    def close(self):
+        super().close()
+        self.closed = True
+        self._stop_stream()
+
+    def _stop_stream(self):
+        if self.pending_timeout is not None:
+            IOLoop.current().remove_timeout(self.pending_timeout)
+            self.pending_timeout = None
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.stream_task is not None:
+            self.stream_task.cancel()
+            self.stream_task = None
+        self.connected = False
+
+    async def disable(self):
+        self._stop_stream()
+        return await super().disable()
+
+    async def update(self) -> None:
+        # Values arrive on their own, periodic update only keeps connection and dial state alive
+        if self.stream_task is None and not self.closed:
+            self.stream_task = asyncio.ensure_future(self._run_stream())
+        # Time dependent modifiers have to run even if value did not change
+        if self.has_volatile_modifiers() and self.raw_value is not None:
+            self._on_value(self.raw_value)
+        self.dial_driver.post_update()
+        self.next_update = time.time() + self.get_update_period()
+        return True
+
+    async def _run_stream(self):
+        delay = self.reconnect_delay
+        while not self.closed:
+            started = time.monotonic()
+            try:
+                if self.protocol == 'websocket':
+                    await self._read_websocket()
+                else:
+                    await self._read_events()
+                logger.warning(f"Stream '{self.cfg['api']['url']}' closed by server")
+            except Exception as e:
+                if self.closed:
+                    return
+                self.metrics.errors += 1
+                logger.error(f"Stream '{self.cfg['api']['url']}' failed: {e}")
+            finally:
+                self.connected = False
+                self.connection = None
+
+            # Connection that stayed up for a while starts backoff over
+            if time.monotonic() - started > self.max_reconnect_delay:
+                delay = self.reconnect_delay
+
+            # Jitter keeps links sharing a server from reconnecting all at once
+            wait = delay * random.uniform(0.5, 1.0)
+            delay = min(delay * 2, self.max_reconnect_delay)
+            self.reconnects += 1
+            logger.info(f"Reconnecting to '{self.cfg['api']['url']}' in {wait:.1f}s")
+            await asyncio.sleep(wait)
+
+    def _on_connected(self):
+        self.connected = True
+        logger.info(f"Link '{self.get_name()}' connected to '{self.cfg['api']['url']}'")
+
+    async def _read_websocket(self):
+        request = HTTPRequest(self.cfg['api']['url'], headers=self.get_headers(), connect_timeout=self.connect_timeout)
+        self.connection = await websocket_connect(request, ping_interval=self.ping_interval or None)
+        self._on_connected()
+        while True:
+            message = await self.connection.read_message()
+            if message is None:
+                return
+            self._on_message(message)
+
+    async def _read_events(self):
+        parser = ServerSentEvents()
+        stream_task = asyncio.current_task()
+        headers = dict(self.get_headers() or {})
+        headers['Accept'] = 'text/event-stream'
+        headers['Cache-Control'] = 'no-cache'
+        if self.last_event_id is not None:
+            headers['Last-Event-ID'] = self.last_event_id
+
+        def on_chunk(chunk):
+            # Stream was stopped or replaced while this transfer was still open
+            if self.closed or self.stream_task is not stream_task:
+                raise StreamClosed("Stream closed")
+            if not self.connected:
+                self._on_connected()
+            for _, data, event_id in parser.feed(chunk):
+                self.last_event_id = event_id
+                self._on_message(data)
+            if parser.retry is not None:
+                # `retry: 0` from server must not turn reconnects into a busy loop
+                self.reconnect_delay = min(max(0.1, parser.retry), self.max_reconnect_delay)
+
+        # Dedicated client, long lived transfer must not hold a slot of the shared one.
+        # Stopped stream is dropped on next chunk, servers send keep-alive comments.
+        client = AsyncHTTPClient(force_instance=True)
+        try:
+            await client.fetch(self.cfg['api']['url'], headers=headers, streaming_callback=on_chunk,
+                               connect_timeout=self.connect_timeout, request_timeout=0)
+        finally:
+            client.close()
+
+    def _on_message(self, message):
+        started = time.perf_counter()
+        try:
+            value = self.item_path.resolve(json.loads(message))
+        except (ValueError, ItemPathError) as e:
+            # Streams often mix in heartbeats and other message types
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Ignoring message from '{self.cfg['api']['url']}': {e}")
+            return
+        finally:
+            self.metrics.parse_seconds.observe(time.perf_counter() - started)
+
+        # Compare with value that is going to be applied, not with the one already shown
+        latest = self.pending_value if self.pending_timeout is not None else self.raw_value
+        if value == latest and not self.has_volatile_modifiers():
+            return
+        self._on_value(value)
+
+    def _on_value(self, value):
+        # Rate limit bursts, only the latest value is kept
+        self.pending_value = value
+        if self.pending_timeout is not None:
+            return
+        wait = self.last_applied + self.min_update_interval - time.monotonic()
+        if wait > 0:
+            self.pending_timeout = IOLoop.current().call_later(wait, self._apply_pending)
+            return
+        self._apply_pending()
+
+    def _apply_pending(self):
+        self.pending_timeout = None
+        # Burst ended on the value already shown
+        if self.pending_value == self.raw_value and not self.has_volatile_modifiers():
+            return
+        self.last_applied = time.monotonic()
+        self.raw_value = self.pending_value
+
+        try:
+            self.ingest_value(self.raw_value)
+        except Exception as e:
+            self.metrics.errors += 1
+            logger.error(f"Link '{self.get_name()}' failed to process value `{self.raw_value}`: {e}")
+            return
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Stream value: {self.raw_value}, final value: {self.api_value}")
+
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        metrics['connected'] = self.connected
+        metrics['reconnects'] = self.reconnects
+        return metrics
@@ -0,0 +1,107 @@
+import asyncio
+from importlib.util import find_spec
+from urllib.parse import urlsplit
+from tornado.httpclient import AsyncHTTPClient
+from apilink.base_logger import logger
+
+HTTP_CLIENTS = ('simple', 'curl')
+
+
+class HttpClientPool:
+    '''
+    HTTP client shared by link and dial drivers.
+
+    Wraps tornado's AsyncHTTPClient so every request goes through one
+    configured client: implementation (`simple` or `curl`), `max_clients`,
+    optional limit of concurrent requests per host, gzip and default
+    timeouts. Drivers pass timeouts from their link config, `None` falls
+    back to the pool defaults.
+
+    Connections are only kept alive and reused with `curl`, tornado's simple
+    client opens a new connection for every request.
+    '''
+    def __init__(self):
+        self.client = 'simple'
+        self.max_clients = 10
+        self.max_per_host = 0       # 0 means no limit
+        self.gzip = True
+        self.connect_timeout = 20.0
+        self.request_timeout = 20.0
+        self.host_limits = {}       # host -> Semaphore
+        self.in_flight = {}         # host -> requests in flight
+        self.requests = 0
+        self.errors = 0
+
+    def configure(self, client='simple', max_clients=10, max_per_host=0, gzip=True, connect_timeout=20.0, request_timeout=20.0):
+        # Has to be called before the first request, tornado keeps one client instance per IOLoop
+        if client not in HTTP_CLIENTS:
+            raise ValueError(f"Unknown HTTP client `{client}`, expected one of {HTTP_CLIENTS}")
+
+        implementation = None
+        if client == 'curl':
+            if find_spec('pycurl') is None:
+                logger.error("HTTP client `curl` requires `pycurl` package. Using `simple` client instead.")
+                client = 'simple'
+            else:
+                implementation = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+
+        self.client = client
+        self.max_clients = max(1, int(max_clients))
+        self.max_per_host = max(0, int(max_per_host))
+        self.gzip = bool(gzip)
+        self.connect_timeout = float(connect_timeout)
+        self.request_timeout = float(request_timeout)
+        self.host_limits.clear()
+        AsyncHTTPClient.configure(implementation, max_clients=self.max_clients)
+
+        logger.info(f"HTTP client: {self.client}, max clients: {self.max_clients}, max per host: {self.max_per_host or 'unlimited'}")
+
+    def _get_host_limit(self, host):
+        if not self.max_per_host:
+            return None
+
+        # Created on first request so it binds to the running loop
+        limit = self.host_limits.get(host, None)
+        if limit is None:
+            limit = asyncio.Semaphore(self.max_per_host)
+            self.host_limits[host] = limit
+        return limit
+
+    async def fetch(self, url, connect_timeout=None, request_timeout=None, **kwargs):
+        host = urlsplit(url).netloc
+        kwargs.setdefault('decompress_response', self.gzip)
+        kwargs['connect_timeout'] = self.connect_timeout if connect_timeout is None else connect_timeout
+        kwargs['request_timeout'] = self.request_timeout if request_timeout is None else request_timeout
+
+        limit = self._get_host_limit(host)
+        if limit is None:
+            return await self._fetch(host, url, kwargs)
+        async with limit:
+            return await self._fetch(host, url, kwargs)
+
+    async def _fetch(self, host, url, kwargs):
+        self.requests += 1
+        self.in_flight[host] = self.in_flight.get(host, 0) + 1
+        try:
+            return await AsyncHTTPClient().fetch(url, **kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight[host] -= 1
+            if not self.in_flight[host]:
+                del self.in_flight[host]
+
+    def get_stats(self):
+        return {
+            'client': self.client,
+            'max_clients': self.max_clients,
+            'max_per_host': self.max_per_host,
+            'in_flight': sum(self.in_flight.values()),
+            'in_flight_per_host': dict(self.in_flight),
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+
+
+http_client = HttpClientPool()
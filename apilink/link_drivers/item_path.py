@@ -0,0 +1,71 @@
+import re
+import ast
+
+
+class ItemPathError(Exception):
+    pass
+
+
+class ItemPath:
+    '''
+    Compiled `api.item` expression.
+
+    Supported forms are the subscript chain used by link files so far
+    (`response['data'][0]["value"]`) and JSONPath-like dot notation
+    (`$.data[0].value`). Expression is parsed once and `resolve()` is
+    just a chain of lookups on the decoded JSON.
+    '''
+    _prefixes = ('response', '$')
+    _token = re.compile(r"""\s*(?:
+                            \.(?P<name>[A-Za-z_][\w\-]*)            # .name
+                          | \[\s*(?P<index>-?\d+)\s*\]              # [0]
+                          | \[\s*(?P<string>'(?:[^'\\]|\\.)*'       # ['key']
+                                           |"(?:[^"\\]|\\.)*")\s*\] # ["key"]
+                          )""", re.VERBOSE)
+
+    def __init__(self, expression):
+        self.expression = str(expression).strip()
+        self.keys = tuple(self._parse(self.expression))
+
+    def _parse(self, expression):
+        for prefix in self._prefixes:
+            if expression.startswith(prefix):
+                position = len(prefix)
+                break
+        else:
+            raise ItemPathError(f"Item `{expression}` must start with `response` or `$`")
+
+        keys = []
+        while position < len(expression):
+            match = self._token.match(expression, position)
+            if match is None:
+                raise ItemPathError(f"Item `{expression}` has invalid syntax at position {position}: `{expression[position:]}`")
+
+            if match.group('name') is not None:
+                keys.append(match.group('name'))
+            elif match.group('index') is not None:
+                keys.append(int(match.group('index')))
+            else:
+                keys.append(ast.literal_eval(match.group('string')))
+            position = match.end()
+
+        return keys
+
+    def _describe(self, depth):
+        return 'response' + ''.join(f'[{key!r}]' for key in self.keys[:depth])
+
+    def resolve(self, data):
+        value = data
+        for depth, key in enumerate(self.keys):
+            try:
+                value = value[key]
+            except KeyError:
+                raise ItemPathError(f"Key {key!r} not found in {self._describe(depth)}") from None
+            except IndexError:
+                raise ItemPathError(f"Index {key} is out of range for {self._describe(depth)} (length {len(value)})") from None
+            except TypeError:
+                raise ItemPathError(f"Can not look up {key!r} in {self._describe(depth)}, value is `{type(value).__name__}`") from None
+        return value
+
+    def __str__(self):
+        return self._describe(len(self.keys))
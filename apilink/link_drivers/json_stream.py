@@ -0,0 +1,322 @@
+import re
+import json
+import logging
+from tornado import httputil
+from apilink.link_drivers.item_path import ItemPathError
+
+_non_whitespace = re.compile(rb'\S')
+_next_in_container = re.compile(rb'["{}\[\]]')
+_next_in_string = re.compile(rb'["\\]')
+_scalar_end = re.compile(rb'[,}\]\s]')
+_string = re.compile(rb'"(?:[^"\\]|\\.)*"', re.DOTALL)
+
+_QUOTE, _BACKSLASH, _COMMA, _COLON = ord('"'), ord('\\'), ord(','), ord(':')
+_OPEN_OBJECT, _CLOSE_OBJECT, _OPEN_ARRAY, _CLOSE_ARRAY = ord('{'), ord('}'), ord('['), ord(']')
+
+
+class StreamAbort(Exception):
+    pass
+
+
+class ResponseTooLarge(StreamAbort):
+    pass
+
+
+class ItemFound(StreamAbort):
+    # Stops downloading rest of the response once item was found
+    pass
+
+
+class _StreamAbortLogFilter(logging.Filter):
+    # Tornado logs exceptions raised from streaming callback as uncaught, even when raised on purpose
+    def filter(self, record):
+        error = record.exc_info[1] if record.exc_info else None
+        while error is not None:
+            if isinstance(error, StreamAbort) or getattr(error, 'stream_aborted', False):
+                return False
+            error = error.__context__
+        return True
+
+
+logging.getLogger('tornado.application').addFilter(_StreamAbortLogFilter())
+
+
+class JsonItemScanner:
+    '''
+    Incremental JSON scanner that extracts a single item from a document.
+
+    Only containers on the item path are tracked, everything else is skipped
+    by counting brackets without being decoded, and consumed bytes are
+    dropped from the buffer. Once the item value is complete it is decoded
+    with `json.loads` and scanning stops, the rest of the document is never
+    looked at. Negative indexes are not supported as they need array length.
+    '''
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.buffer = bytearray()
+        self.pos = 0
+        self.stack = []     # Containers on the item path, [is_array, current index]
+        self.state = 'value'
+        self.value_kind = 'target' if not self.keys else 'path'
+        self.key = None
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.scalar = False
+        self.capture_start = None
+        self.found = False
+        self.value = None
+
+    def feed(self, chunk):
+        if self.found:
+            return True
+
+        self.buffer += chunk
+        try:
+            self._run()
+        finally:
+            # Drop everything that was already consumed, keep item bytes being captured
+            keep = self.pos if self.capture_start is None else self.capture_start
+            if keep > 0:
+                del self.buffer[:keep]
+                self.pos -= keep
+                if self.capture_start is not None:
+                    self.capture_start = 0
+        return self.found
+
+    def finish(self):
+        # Called once whole body was received
+        if self.found:
+            return self.value
+
+        # Scalar at the very end of the document has no delimiter after it
+        if self.state == 'consume' and self.scalar and self.capture_start is not None:
+            self.pos = len(self.buffer)
+            self._finish_capture()
+            return self.value
+
+        raise ItemPathError(f"Response ended before {self._describe(len(self.keys))} was found")
+
+    def _describe(self, depth):
+        return 'response' + ''.join(f'[{key!r}]' for key in self.keys[:depth])
+
+    def _error(self, message):
+        return ValueError(f"Invalid JSON at {self._describe(len(self.stack))}: {message}")
+
+    def _run(self):
+        buf = self.buffer
+        while not self.found:
+            if self.state == 'consume':
+                if not self._consume():
+                    return
+                if self.capture_start is not None:
+                    self._finish_capture()
+                    return
+                self.state = 'after'
+                continue
+
+            match = _non_whitespace.search(buf, self.pos)
+            if match is None:
+                self.pos = len(buf)
+                return
+            self.pos = match.start()
+            char = buf[self.pos]
+
+            if self.state == 'value':
+                self._start_value(char)
+            elif self.state == 'key':
+                if char == _CLOSE_OBJECT:
+                    raise ItemPathError(f"Key {self.keys[len(self.stack) - 1]!r} not found in {self._describe(len(self.stack) - 1)}")
+                match = _string.match(buf, self.pos)
+                if match is None:
+                    if char != _QUOTE:
+                        raise self._error(f"expected key, got `{chr(char)}`")
+                    return  # Key is not complete yet
+                self.key = json.loads(match.group())
+                self.pos = match.end()
+                self.state = 'colon'
+            elif self.state == 'colon':
+                if char != _COLON:
+                    raise self._error(f"expected `:`, got `{chr(char)}`")
+                self.pos += 1
+                self._next_value(self.key)
+            elif self.state == 'first':
+                # Right after `[`, array might be empty
+                if char == _CLOSE_ARRAY:
+                    self._raise_out_of_range()
+                self._next_value(0)
+            elif self.state == 'after':
+                self._after_value(char)
+
+    def _start_value(self, char):
+        if self.value_kind == 'target':
+            self.capture_start = self.pos
+            self._start_consume(char)
+        elif self.value_kind == 'skip':
+            self._start_consume(char)
+        else:
+            # Container on the item path, it has to match type of the next key
+            key = self.keys[len(self.stack)]
+            if isinstance(key, int) and char == _OPEN_ARRAY:
+                self.stack.append([True, 0])
+                self.state = 'first'
+            elif isinstance(key, str) and char == _OPEN_OBJECT:
+                self.stack.append([False, None])
+                self.state = 'key'
+            else:
+                raise ItemPathError(f"Can not look up {key!r} in {self._describe(len(self.stack))}, value is not a matching container")
+            self.pos += 1
+
+    def _next_value(self, key):
+        depth = len(self.stack)
+        if key == self.keys[depth - 1]:
+            self.value_kind = 'target' if depth == len(self.keys) else 'path'
+        else:
+            self.value_kind = 'skip'
+        self.state = 'value'
+
+    def _after_value(self, char):
+        is_array, index = self.stack[-1]
+        if char == _COMMA:
+            self.pos += 1
+            if is_array:
+                self.stack[-1][1] = index + 1
+                self._next_value(index + 1)
+            else:
+                self.state = 'key'
+        elif is_array and char == _CLOSE_ARRAY:
+            self._raise_out_of_range()
+        elif not is_array and char == _CLOSE_OBJECT:
+            raise ItemPathError(f"Key {self.keys[len(self.stack) - 1]!r} not found in {self._describe(len(self.stack) - 1)}")
+        else:
+            raise self._error(f"unexpected `{chr(char)}`")
+
+    def _raise_out_of_range(self):
+        depth = len(self.stack) - 1
+        raise ItemPathError(f"Index {self.keys[depth]} is out of range for {self._describe(depth)}")
+
+    def _start_consume(self, char):
+        self.state = 'consume'
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.scalar = False
+
+        if char in (_OPEN_OBJECT, _OPEN_ARRAY):
+            self.depth = 1
+            self.pos += 1
+        elif char == _QUOTE:
+            self.in_string = True
+            self.pos += 1
+        else:
+            self.scalar = True
+
+    def _consume(self):
+        # Returns True once the whole value was consumed, False if more data is needed
+        buf = self.buffer
+        if self.scalar:
+            match = _scalar_end.search(buf, self.pos)
+            if match is None:
+                self.pos = len(buf)
+                return False
+            self.pos = match.start()
+            return True
+
+        while True:
+            if self.in_string:
+                if self.escape:
+                    if self.pos >= len(buf):
+                        return False
+                    self.pos += 1
+                    self.escape = False
+
+                match = _next_in_string.search(buf, self.pos)
+                if match is None:
+                    self.pos = len(buf)
+                    return False
+                self.pos = match.end()
+
+                if buf[match.start()] == _BACKSLASH:
+                    self.escape = True
+                    continue
+                self.in_string = False
+                if self.depth == 0:
+                    return True
+                continue
+
+            match = _next_in_container.search(buf, self.pos)
+            if match is None:
+                self.pos = len(buf)
+                return False
+            self.pos = match.end()
+
+            char = buf[match.start()]
+            if char == _QUOTE:
+                self.in_string = True
+            elif char in (_OPEN_OBJECT, _OPEN_ARRAY):
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+
+    def _finish_capture(self):
+        self.value = json.loads(bytes(self.buffer[self.capture_start:self.pos]))
+        self.found = True
+
+
+class ResponseReader:
+    '''
+    Streaming and header callbacks for `AsyncHTTPClient.fetch`.
+
+    Enforces `max_body_size` (0 means no limit) and either collects the body
+    or hands it to a JsonItemScanner, aborting as soon as the item is
+    resolved. Bodies of non-2xx responses are collected but not scanned.
+
+    Tornado reports transfer aborted from a callback as closed connection,
+    reason is kept in `aborted` (ItemFound, ResponseTooLarge or the error
+    scanner failed with).
+    '''
+    def __init__(self, max_body_size=0, scanner=None):
+        self.max_body_size = max_body_size
+        self.scanner = scanner
+        self.code = None
+        self.headers = httputil.HTTPHeaders()
+        self.chunks = []
+        self.size = 0
+        self.aborted = None
+
+    def _abort(self, reason):
+        # Marked so log filter drops it when tornado reports it as uncaught
+        reason.stream_aborted = True
+        self.aborted = reason
+        raise reason
+
+    def on_header(self, line):
+        line = line.rstrip('\r\n')
+        if self.code is None:
+            self.code = httputil.parse_response_start_line(line).code
+        elif line:
+            self.headers.parse_line(line)
+
+    def on_chunk(self, chunk):
+        if self.aborted is not None:
+            return
+        self.size += len(chunk)
+        if self.max_body_size and self.size > self.max_body_size:
+            self._abort(ResponseTooLarge(f"Response is larger than {self.max_body_size} bytes"))
+
+        if self.scanner is not None and self.code is not None and 200 <= self.code < 300:
+            try:
+                found = self.scanner.feed(chunk)
+            except (ItemPathError, ValueError) as e:
+                # Unusable document, fetch re-raises it once transfer is stopped
+                self._abort(e)
+            else:
+                if found:
+                    self._abort(ItemFound())
+        else:
+            self.chunks.append(chunk)
+
+    def get_body(self):
+        return b''.join(self.chunks)
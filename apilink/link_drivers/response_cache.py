@@ -0,0 +1,120 @@
+import time
+import asyncio
+
+# Returned by loader when upstream answered `304 Not Modified`
+NOT_MODIFIED = object()
+
+
+class CacheEntry:
+    __slots__ = ('payload', 'fetched_at', 'version', 'etag', 'last_modified')
+
+    def __init__(self, payload, fetched_at, version, etag=None, last_modified=None):
+        self.payload = payload
+        self.fetched_at = fetched_at
+        self.version = version  # Only changes when payload changes
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class ResponseCache:
+    '''
+    Process wide cache of upstream API responses shared between links.
+
+    Links polling the same URL with the same headers register under one key.
+    Cached payload is reused for as long as the shortest `update_period` of
+    the registered links, and concurrent requests for a key that is being
+    fetched wait for that single fetch instead of starting their own.
+
+    Entries outlive their TTL so `ETag` / `Last-Modified` of the last response
+    can be used for conditional requests. `304 Not Modified` only refreshes
+    the entry, its payload and version stay the same.
+    '''
+    def __init__(self):
+        self.entries = {}    # key -> CacheEntry
+        self.in_flight = {}  # key -> Future resolving to CacheEntry
+        self.users = {}      # key -> {owner: ttl}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+
+    @staticmethod
+    def make_key(url, headers=None, variant=None):
+        headers = headers or {}
+        return (str(url), tuple(sorted((str(key).lower(), str(value)) for key, value in headers.items())), variant)
+
+    def register(self, key, owner, ttl):
+        self.users.setdefault(key, {})[owner] = float(ttl)
+
+    def unregister(self, key, owner):
+        users = self.users.get(key, None)
+        if users is None:
+            return
+
+        users.pop(owner, None)
+        if not users:
+            del self.users[key]
+            self.entries.pop(key, None)
+
+    def get_ttl(self, key):
+        users = self.users.get(key, None)
+        if not users:
+            return 0
+        return min(users.values())
+
+    async def get(self, key, loader):
+        '''
+        Return CacheEntry for `key`, calling `loader(entry)` only when there is
+        no fresh entry and no fetch in flight. Loader is a coroutine receiving
+        the previous entry (or None) and returning `(payload, etag, last_modified)`
+        where payload can be NOT_MODIFIED.
+        '''
+        entry = self.entries.get(key, None)
+        if entry is not None and time.time() - entry.fetched_at < self.get_ttl(key):
+            self.hits += 1
+            return entry
+
+        pending = self.in_flight.get(key, None)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            payload, etag, last_modified = await loader(entry)
+            if payload is NOT_MODIFIED:
+                if entry is None:
+                    raise ValueError(f"Got `304 Not Modified` for `{key[0]}` without cached response")
+                self.not_modified += 1
+                entry.fetched_at = time.time()
+            else:
+                version = entry.version + 1 if entry is not None else 1
+                entry = CacheEntry(payload, time.time(), version, etag, last_modified)
+                if key in self.users:
+                    self.entries[key] = entry
+            future.set_result(entry)
+            return entry
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Waiters get the error, don't warn if there were none
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            del self.in_flight[key]
+
+    def get_stats(self):
+        return {
+            'keys': len(self.users),
+            'entries': len(self.entries),
+            'in_flight': len(self.in_flight),
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'not_modified': self.not_modified,
+        }
+
+
+response_cache = ResponseCache()
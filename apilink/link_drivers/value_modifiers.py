@@ -1,9 +1,21 @@
 import time
+import logging
 import random
 from datetime import datetime as dt
 from apilink.base_logger import logger
 
 class ValueModifiers:
+    # Modifiers whose result changes over time even when input value does not
+    volatile_modifiers = ('unix_time_delta', 'str_datetime_delta', 'random_value')
+
+    # Numeric arguments are converted once when modifier chain is compiled
+    argument_types = {
+        'value_clip': {'min': float, 'max': float},
+        'offset': {'amount': float},
+        'scale_number': {'min': float, 'max': float},
+        'random_value': {'min': int, 'max': int},
+    }
+
     def __init__(self):
         pass
 
@@ -12,16 +24,17 @@ class ValueModifiers:
 
         if unit in div:
             result = round(value/div[unit], 1)
-            logger.debug(f"_util_convert_seconds: Scaling value `{value}` seconds to `{unit}` -> {result}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"_util_convert_seconds: Scaling value `{value}` seconds to `{unit}` -> {result}")
             return result
 
-        logger(f"_util_convert_seconds: Invalid unit specified `{unit}`")
+        logger.error(f"_util_convert_seconds: Invalid unit specified `{unit}`")
         return 0
 
     def value_clip(self, **kwargs):
         value = float(kwargs.get('value', 0.0))
-        value_min = float(kwargs['args'].get('min', 0.0))
-        value_max = float(kwargs['args'].get('max', 100.0))
+        value_min = kwargs['args'].get('min', 0.0)
+        value_max = kwargs['args'].get('max', 100.0)
 
         try:
             if int(value) >= value_max:
@@ -38,18 +51,19 @@ class ValueModifiers:
 
     def offset(self, **kwargs):
         value = float(kwargs.get('value', 0.0))
-        offset_amount = float(kwargs['args'].get('amount', 0.0))
+        offset_amount = kwargs['args'].get('amount', 0.0)
         return value + offset_amount
 
     def absolute(self, **kwargs):
         value = float(kwargs.get('value', 0.0))
-        logger.debug(f"Returning absolute value of {value} as {abs(value)}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Returning absolute value of {value} as {abs(value)}")
         return abs(value)
 
     def scale_number(self, **kwargs):
         value = float(kwargs.get('value', 0.0))
-        scale_min = float(kwargs['args'].get('min', 0.0))
-        scale_max = float(kwargs['args'].get('max', 100.0))
+        scale_min = kwargs['args'].get('min', 0.0)
+        scale_max = kwargs['args'].get('max', 100.0)
 
         ret_value = (value-scale_min) / (scale_max - scale_min) * 100
         if value > scale_max:
@@ -57,7 +71,8 @@ class ValueModifiers:
         elif value < scale_min:
             ret_value = scale_min
 
-        logger.debug(f"Initial value was: {value} scaled to: {ret_value} (using min:{scale_min} max:{scale_max})")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Initial value was: {value} scaled to: {ret_value} (using min:{scale_min} max:{scale_max})")
         return ret_value
 
     def unix_time_delta(self, **kwargs):
@@ -75,7 +90,8 @@ class ValueModifiers:
         else:
             ret_value = value - compare_to
 
-        logger.debug(f"Value before conversion {ret_value}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Value before conversion {ret_value}")
         return self._util_convert_seconds(ret_value, unit)
 
 
@@ -100,7 +116,8 @@ class ValueModifiers:
             else:
                 delta = round((compare_date - compare_to).total_seconds(), 1)
 
-            logger.debug(f"Delta `{calculate}` between {compare_to} and {compare_date} is `{delta}` seconds.")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Delta `{calculate}` between {compare_to} and {compare_date} is `{delta}` seconds.")
 
             return self._util_convert_seconds(delta, unit)
 
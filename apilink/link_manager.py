@@ -1,46 +1,177 @@
 import os
 import re
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from tornado.ioloop import IOLoop, PeriodicCallback
 from apilink.vu_filesystem import VU_FileSystem
 from apilink.base_logger import logger
+from apilink.link_scheduler import LinkScheduler
+from apilink.metrics import to_prometheus
 from apilink.link_drivers.driver_requests import Driver_Requests
+from apilink.link_drivers.driver_stream import Driver_Stream
+from apilink.link_drivers.driver_push import Driver_Push
+from apilink.link_drivers.base_link_driver import BaseLinkDriver
+from apilink.link_drivers.base_dial_driver import image_cache
+from apilink.link_drivers.config_writer import config_writer
+from apilink.link_drivers.response_cache import response_cache
+from apilink.link_drivers.http_client import http_client
+from apilink.link_drivers.config_loader import LinkConfigCache, read_link_config, read_file_signature, get_content_digest
+
+# Link file name prefix -> driver
+LINK_DRIVERS = {
+    'requests': Driver_Requests,
+    'stream': Driver_Stream,
+    'push': Driver_Push,
+}
 
 
 class LinkManager:
     links = {}
 
-    def __init__(self):
+    def __init__(self, max_concurrent_updates=16, schedule_jitter=5.0, http_client_options=None, watch_interval=0, history_size=1024):
+        # pylint: disable=too-many-arguments
         self.links_path =  VU_FileSystem.get_links_folder_path()
-        logger.info(f"Loading API Llinks from {self.links_path}")
-        self._load_available_links()
-
-    def _load_available_links(self):
+        self.link_files = {}    # link_file -> (mtime, size, content hash) of the file when it was loaded
+        self.watch_interval = max(0.0, float(watch_interval))
+        self.watcher = None
+        self.loading = False
+        self.config_cache = LinkConfigCache(VU_FileSystem.get_link_cache_file_path())
+        # Drivers share one HTTP client, it has to be configured before links are loaded
+        http_client.configure(**(http_client_options or {}))
+        self.max_concurrent_updates = max(1, int(max_concurrent_updates))
+        self.update_semaphore = None  # Created on first update so it binds to the running loop
+        self.updates_in_flight = set()
+        self.gauges = {}    # Extra process wide metrics, name -> callback returning current value
+        self.scheduler = LinkScheduler(self._dispatch_link, jitter=schedule_jitter)
+        # Links without their own `history_size` use this one
+        BaseLinkDriver.history_size = max(0, int(history_size))
+
+    def _list_link_files(self, log_invalid=False):
         config_files = os.listdir(self.links_path)
         config_files = [item for item in config_files if item.endswith('.toml')]
 
+        link_files = []
         for cfg in config_files:
             if re.match(r"^[0-9a-z\-_\.]*?\.toml$", cfg, re.IGNORECASE):
-                self._load_link(cfg)
-            else:
+                link_files.append(cfg)
+            elif log_invalid:
                 logger.error(f"Found .toml link file with invalid name (`{cfg}`)")
+        return link_files
 
+    def _load_available_links(self):
+        for cfg in self._list_link_files(log_invalid=True):
+            # Spread first update of links loaded together
+            self._load_link(cfg, jitter=True)
+
+    async def load_links(self, batch_size=50):
+        '''
+        Load all links without blocking the IOLoop for long. Files are read
+        and parsed on worker threads (unchanged ones come from config cache),
+        drivers are created on the loop in batches so requests are served
+        while links are still loading.
+        '''
+        self.loading = True
+        started = time.time()
+        logger.info(f"Loading API Llinks from {self.links_path}")
+
+        try:
+            await self._load_link_files(batch_size)
+        finally:
+            self.loading = False
+        logger.info(f"Loaded {len(self.links)} links in {time.time() - started:.2f}s")
+
+    async def _load_link_files(self, batch_size):
+        io_loop = IOLoop.current()
+        link_files = self._list_link_files(log_invalid=True)
+        with ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='link_loader') as executor:
+            await io_loop.run_in_executor(executor, self.config_cache.load)
+            futures = [io_loop.run_in_executor(executor, read_link_config, os.path.join(self.links_path, link_file),
+                                               link_file, self.config_cache)
+                       for link_file in link_files]
+
+            for index, (link_file, future) in enumerate(zip(link_files, futures)):
+                # One broken link file must not stop the rest from loading
+                try:
+                    loaded = await future
+                    if loaded is None:
+                        # Driver reads the file itself and reports what is wrong with it
+                        self._load_link(link_file, jitter=True)
+                    else:
+                        cfg, signature, snapshot = loaded
+                        if self._load_link(link_file, jitter=True, cfg=cfg, signature=signature) and snapshot is not None:
+                            self.config_cache.put(link_file, signature, snapshot)
+                except Exception as e:
+                    logger.error(f"Failed to load link `{link_file}`: {e}")
+                    logger.error("This link will be ignored")
+
+                if index % batch_size == batch_size - 1:
+                    await asyncio.sleep(0)
+
+            self.config_cache.retain(self.links)
+            try:
+                await io_loop.run_in_executor(executor, self.config_cache.save)
+            except OSError as e:
+                logger.error(f"Failed to save link config cache: {e}")
+
+    def is_loading(self):
+        return self.loading
+
+    def _remember_link_file(self, link_file, signature=None):
+        # Failed links are remembered too, they are only retried once their file changes
+        if signature is not None:
+            self.link_files[link_file] = signature
+            return
+        try:
+            self.link_files[link_file] = read_file_signature(os.path.join(self.links_path, link_file))
+        except OSError:
+            self.link_files.pop(link_file, None)
+
+    def _link_file_changed(self, link_file):
+        mtime, size, digest = self.link_files[link_file]
+        stat = os.stat(os.path.join(self.links_path, link_file))
+        if stat.st_mtime_ns == mtime and stat.st_size == size:
+            return False
 
-    def _load_link(self, link_file):
+        signature = read_file_signature(os.path.join(self.links_path, link_file))
+        if signature[2] == digest or signature[2] == self._get_saved_digest(link_file):
+            # Only touched, or written by the link itself when saving its config
+            self.link_files[link_file] = signature
+            return False
+        return True
+
+    def _get_saved_digest(self, link_file):
+        driver = self.links.get(link_file, None)
+        # Links that were never edited did not write their file. Saved document
+        # that picked up an outside edit must not pass as link's own write.
+        if driver is None or not driver.is_config_edited() or driver.is_config_outdated():
+            return None
+        return get_content_digest(driver.dump_config().encode('utf-8'))
+
+    def _load_link(self, link_file, jitter=False, cfg=None, signature=None):
         logger.debug(f"Setting up link for {link_file}")
+        self._remember_link_file(link_file, signature)
 
-        if link_file.startswith('requests'):
-            link_driver = Driver_Requests(link_file)
+        for prefix, driver_class in LINK_DRIVERS.items():
+            if not link_file.startswith(prefix):
+                continue
+            link_driver = driver_class(link_file, cfg)
+            if link_file in self.link_files:
+                link_driver.cfg_digest = self.link_files[link_file][2]
 
             if link_driver.is_ready():
                 self._disable_if_dial_in_use(link_driver)
                 self.links[link_file] = link_driver
-                logger.info(f"Created '{link_driver.get_name()}' using 'requests' driver")
-                return
+                self._schedule_link(link_file, jitter=jitter)
+                logger.info(f"Created '{link_driver.get_name()}' using '{prefix}' driver")
+                return True
 
-            logger.info("Attempted to create 'link_driver.get_name()' using 'requests' but driver failed to start!")
-            return
+            logger.info(f"Attempted to create '{link_file}' using '{prefix}' driver but driver failed to start!")
+            return False
 
         # Catch-all
         logger.error(f"Config '{link_file}' has no driver.'")
+        return False
 
     def _disable_if_dial_in_use(self, driver):
         return
@@ -55,10 +186,13 @@ class LinkManager:
 
     def _unload_link(self, filename):
         # Remove link from loaded links
+        self.scheduler.remove(filename)
+        config_writer.discard(filename)
         res = self.links.pop(filename, None)
         if res is None:
             logger.error(f"Requested link `{filename}` does not exist.")
         else:
+            res.close()
             logger.info(f"Requested link `{filename}` unloaded.")
 
 
@@ -67,9 +201,61 @@ class LinkManager:
             return False
         return True
 
-    def reload_all_links(self):
-        backup_links = self.links
+    def _schedule_link(self, link_file, jitter=False):
+        driver = self.links.get(link_file, None)
+        if driver is None or not driver.is_enabled():
+            self.scheduler.remove(link_file)
+            return
+
+        jitter_limit = None
+        if jitter:
+            jitter_limit = driver.get_update_period()
+        deadline = max(driver.get_next_update(), time.time())
+        self.scheduler.schedule(link_file, deadline, jitter_limit=jitter_limit)
+
+    def start(self):
+        self.scheduler.start()
+        if self.watch_interval > 0 and self.watcher is None:
+            self.watcher = PeriodicCallback(self._watch_links, self.watch_interval * 1000)
+            self.watcher.start()
+
+    def stop(self):
+        self.scheduler.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+
+    def _watch_links(self):
+        if self.loading:
+            return
+        try:
+            changes = self.reload_changed_links()
+        except OSError as e:
+            logger.error(f"Failed to check link files for changes: {e}")
+            return
+
+        if any(changes.values()):
+            logger.info(f"Link files changed on disk: {changes}")
+
+    def flush_configs(self):
+        config_writer.flush_sync()
+
+    def reload_all_links(self, full=False):
+        if self.loading:
+            logger.error("Links are still loading, reload skipped")
+            return {'added': [], 'changed': [], 'removed': []}
+
+        # Persist pending config changes before re-reading the files
+        self.flush_configs()
+        if not full:
+            return self.reload_changed_links()
+
+        backup_links = dict(self.links)
+        self.scheduler.clear()
+        for driver in self.links.values():
+            driver.close()
         self.links.clear()
+        self.link_files.clear()
         self._load_available_links()
 
         # Restore next update
@@ -77,6 +263,35 @@ class LinkManager:
             previous = backup_links.get(key, None)
             if previous is not None:
                 driver.set_next_update(previous.get_next_update())
+                self._schedule_link(key, jitter=True)
+        return {'added': [], 'changed': list(self.links), 'removed': [key for key in backup_links if key not in self.links]}
+
+    def reload_changed_links(self):
+        '''
+        Re-create only links whose file was added, removed or changed since it
+        was loaded. Untouched links keep their driver, schedule and dial state.
+        '''
+        changes = {'added': [], 'changed': [], 'removed': []}
+        current = set(self._list_link_files())
+
+        for link_file in list(self.link_files):
+            if link_file not in current:
+                del self.link_files[link_file]
+                if self._link_exists(link_file):
+                    self._unload_link(link_file)
+                changes['removed'].append(link_file)
+
+        for link_file in sorted(current):
+            if link_file not in self.link_files:
+                self._load_link(link_file, jitter=True)
+                changes['added'].append(link_file)
+            elif self._link_file_changed(link_file):
+                if self._link_exists(link_file):
+                    self._unload_link(link_file)
+                self._load_link(link_file)
+                changes['changed'].append(link_file)
+
+        return changes
 
     def get_link_contents(self, link_file, raw=False):
         if not self._link_exists(link_file):
@@ -85,13 +300,22 @@ class LinkManager:
 
         return self.links[link_file].get_config(raw=raw)
 
-    def enable_link(self, link_file):
+    def get_link_history(self, link_file, since=0.0, step=None):
+        if not self._link_exists(link_file):
+            logger.error(f"Link `{link_file}` does not exist!")
+            return None
+
+        return self.links[link_file].get_history(since=since, step=step)
+
+    async def enable_link(self, link_file):
         if not self._link_exists(link_file):
             logger.error(f"Link `{link_file}` does not exist!")
             return False
 
         logger.info(f"Link `{link_file}` enabled.")
-        return self.links[link_file].enable()
+        res = await self.links[link_file].enable()
+        self._schedule_link(link_file)
+        return res
 
     async def disable_link(self, link_file):
         if not self._link_exists(link_file):
@@ -99,6 +323,7 @@ class LinkManager:
             return False
 
         logger.info(f"Link `{link_file}` disabled.")
+        self.scheduler.remove(link_file)
         return await self.links[link_file].disable()
 
     def delete_link(self, link_file):
@@ -112,6 +337,7 @@ class LinkManager:
 
         # Remove link from loaded links
         self._unload_link(link_file)
+        self.link_files.pop(link_file, None)
 
         # Remove link file
         rem_filepath = os.path.join(self.links_path, link_file)
@@ -170,13 +396,108 @@ class LinkManager:
         return True
 
 
+    def get_cache_stats(self):
+        return response_cache.get_stats()
+
+    def get_http_stats(self):
+        return http_client.get_stats()
+
+    async def get_image(self, image_path):
+        # Same cache dial drivers use, so image is read from disk once for dials and web UI
+        return await image_cache.get_async(image_path)
+
+    def invalidate_image(self, image_path):
+        image_cache.invalidate(image_path)
+
+    def add_gauge(self, name, callback):
+        self.gauges[name] = callback
+
+    def get_metrics(self):
+        # Everything is collected here, recording metrics during updates is just counters and histograms
+        http_stats = http_client.get_stats()
+        process = {
+            'tick_seconds': self.scheduler.tick_seconds.to_dict(),
+            'links_loaded': len(self.links),
+            'updates_in_flight': len(self.updates_in_flight),
+            'http_requests_in_flight': http_stats['in_flight'],
+            'http_requests': http_stats['requests'],
+            'http_errors': http_stats['errors'],
+        }
+        for name, callback in self.gauges.items():
+            process[name] = callback()
+
+        links = {link_file: driver.get_metrics() for link_file, driver in self.links.items()}
+        return {'process': process, 'links': links}
+
+    def get_metrics_text(self):
+        return to_prometheus(self.get_metrics())
+
+    def push_value(self, link_file, value):
+        '''
+        Feed value sent by a producer into a push link.
+        Returns `ok`, `unknown_link`, `not_push_link`, `disabled`,
+        `rate_limited` or `invalid_value`.
+        '''
+        link_driver = self.links.get(link_file, None)
+        if link_driver is None:
+            return 'unknown_link'
+        if not link_driver.accepts_push:
+            return 'not_push_link'
+        if not link_driver.is_enabled():
+            return 'disabled'
+
+        try:
+            if not link_driver.push_value(value):
+                return 'rate_limited'
+        except (TypeError, ValueError) as e:
+            logger.debug(f"Invalid value pushed to `{link_file}`: {e}")
+            return 'invalid_value'
+        return 'ok'
+
     def get_active_links(self):
         configs = []
         for _, driver in self.links.items():
             configs.append(driver.get_config())
         return configs
 
-    async def async_periodic_update(self) -> None:
-        for _, link_driver in self.links.items():
-            if link_driver.is_enabled():
-                await link_driver.update()
+    def _dispatch_link(self, link_file, deadline):
+        link_driver = self.links.get(link_file, None)
+        if link_driver is None or not link_driver.is_enabled():
+            return
+
+        # Link is still busy with previous update, it will be re-scheduled once that one finishes
+        if link_file in self.updates_in_flight:
+            return
+
+        if self.update_semaphore is None:
+            self.update_semaphore = asyncio.Semaphore(self.max_concurrent_updates)
+
+        # Each link runs as its own task so slow or failing links can not hold back the rest
+        self.updates_in_flight.add(link_file)
+        IOLoop.current().spawn_callback(self._update_link, link_file, link_driver, deadline)
+
+    async def _update_link(self, link_file, link_driver, deadline):
+        try:
+            async with self.update_semaphore:
+                link_driver.metrics.lateness_seconds.observe(max(0.0, time.time() - deadline))
+                result = await link_driver.update()
+            if result:
+                link_driver.metrics.last_success = time.time()
+            elif result is False:
+                link_driver.metrics.errors += 1
+        except Exception as e:
+            link_driver.metrics.errors += 1
+            logger.error(f"Link `{link_file}` failed to update: {e}")
+        finally:
+            self.updates_in_flight.discard(link_file)
+
+            # Failed update did not move next update forward, back off instead of retrying right away.
+            # Short period links retry after one period, not after the full retry delay.
+            now = time.time()
+            if link_driver.get_next_update() <= now:
+                retry_delay = min(link_driver.retry_delay, max(1, link_driver.get_update_period()))
+                link_driver.set_next_update(now + retry_delay)
+
+            # Link might have been reloaded or removed while update was running
+            if self.links.get(link_file, None) is link_driver:
+                self._schedule_link(link_file)
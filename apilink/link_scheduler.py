@@ -0,0 +1,127 @@
+import time
+import heapq
+import random
+from tornado.ioloop import IOLoop
+from apilink.base_logger import logger
+from apilink.metrics import Histogram
+
+
+class LinkScheduler:
+    '''
+    Deadline driven scheduler for link updates.
+
+    Links are kept in a min-heap ordered by their next update time and only one
+    IOLoop timeout is armed, for whichever link is due first. Re-scheduling or
+    removing a link does not touch the heap, older entries are simply skipped
+    once they reach the top (lazy deletion).
+    '''
+    def __init__(self, callback, jitter=5.0):
+        self.callback = callback    # Called with `link_file` and its deadline once link is due
+        self.jitter = max(0.0, float(jitter))
+        self.queue = []             # Heap of (deadline, sequence, link_file)
+        self.entries = {}           # link_file -> (deadline, sequence) of the valid heap entry
+        self.sequence = 0
+        self.running = False
+        self.timeout = None
+        self.timeout_deadline = None
+        self.tick_seconds = Histogram()
+
+    def start(self):
+        self.running = True
+        self._rearm()
+
+    def stop(self):
+        self.running = False
+        self._cancel_timeout()
+
+    def schedule(self, link_file, deadline, jitter_limit=None):
+        '''
+        Schedule (or re-schedule) `link_file` to run at `deadline` (unix time).
+        When `jitter_limit` is given, random delay up to min(jitter, jitter_limit)
+        is added so links sharing the same period don't all fire at once.
+        '''
+        if jitter_limit is not None:
+            deadline += random.uniform(0, min(self.jitter, max(0.0, float(jitter_limit))))
+
+        self.sequence += 1
+        self.entries[link_file] = (deadline, self.sequence)
+        heapq.heappush(self.queue, (deadline, self.sequence, link_file))
+
+        # Too many stale entries, rebuild heap from valid ones
+        if len(self.queue) > 2 * len(self.entries) + 64:
+            self.queue = [(dl, seq, name) for name, (dl, seq) in self.entries.items()]
+            heapq.heapify(self.queue)
+
+        self._rearm()
+
+    def remove(self, link_file):
+        if self.entries.pop(link_file, None) is not None:
+            self._rearm()
+
+    def clear(self):
+        self.entries.clear()
+        self.queue.clear()
+        self._cancel_timeout()
+
+    def is_scheduled(self, link_file):
+        return link_file in self.entries
+
+    def get_deadline(self, link_file):
+        entry = self.entries.get(link_file, None)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def _is_valid(self, item):
+        deadline, sequence, link_file = item
+        return self.entries.get(link_file, None) == (deadline, sequence)
+
+    def _drop_stale(self):
+        while self.queue and not self._is_valid(self.queue[0]):
+            heapq.heappop(self.queue)
+
+    def _cancel_timeout(self):
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+        self.timeout = None
+        self.timeout_deadline = None
+
+    def _rearm(self):
+        if not self.running:
+            return
+
+        self._drop_stale()
+        if not self.queue:
+            self._cancel_timeout()
+            return
+
+        deadline = self.queue[0][0]
+        if self.timeout is not None and self.timeout_deadline == deadline:
+            return
+
+        self._cancel_timeout()
+        self.timeout_deadline = deadline
+        self.timeout = IOLoop.current().call_later(max(0.0, deadline - time.time()), self._run_due)
+
+    def _run_due(self):
+        self.timeout = None
+        self.timeout_deadline = None
+
+        started = time.perf_counter()
+        now = time.time()
+        due = []
+        while self.queue and self.queue[0][0] <= now:
+            item = heapq.heappop(self.queue)
+            if self._is_valid(item):
+                # Link stays unscheduled until its owner re-schedules it
+                del self.entries[item[2]]
+                due.append((item[2], item[0]))
+
+        for link_file, deadline in due:
+            try:
+                self.callback(link_file, deadline)
+            except Exception as e:
+                logger.error(f"Failed to dispatch link `{link_file}`: {e}")
+
+        self._rearm()
+        self.tick_seconds.observe(time.perf_counter() - started)
@@ -0,0 +1,115 @@
+import sys
+import time
+import threading
+import traceback
+from collections import deque
+from tornado.ioloop import IOLoop
+from apilink.base_logger import logger
+from apilink.metrics import Histogram
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class LoopMonitor:
+    '''
+    Measures how late the IOLoop runs a callback scheduled every `interval`
+    seconds. Recent samples are kept for percentiles, all of them go to a
+    histogram for metrics.
+
+    A watchdog thread checks that the loop keeps running. When the loop has
+    been blocked for longer than `threshold` seconds, the stack of the loop
+    thread is logged once, together with the link or request handler it is
+    working on. `threshold` of 0 disables the watchdog.
+    '''
+    def __init__(self, interval=0.5, threshold=0.25, history=1200):
+        self.interval = max(0.01, float(interval))
+        self.threshold = max(0.0, float(threshold))
+        self.samples = deque(maxlen=history)
+        self.lag_seconds = Histogram(LAG_BUCKETS)
+        self.stalls = 0
+        self.expected = None
+        self.heartbeat = None
+        self.timeout = None
+        self.loop_thread_id = None
+        self.stop_event = threading.Event()
+        self.watchdog = None
+
+    def start(self):
+        # Has to be called from the IOLoop thread
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.expected = self.heartbeat + self.interval
+        self.timeout = IOLoop.current().call_later(self.interval, self._sample)
+
+        if self.threshold > 0:
+            self.stop_event.clear()
+            self.watchdog = threading.Thread(target=self._watch, name='loop_watchdog', daemon=True)
+            self.watchdog.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.timeout is not None:
+            IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _sample(self):
+        now = time.monotonic()
+        lag = max(0.0, now - self.expected)
+        self.samples.append(lag)
+        self.lag_seconds.observe(lag)
+        if self.threshold and lag > self.threshold:
+            logger.warning(f"IOLoop was blocked for {lag:.3f}s")
+
+        self.heartbeat = now
+        self.expected = now + self.interval
+        self.timeout = IOLoop.current().call_later(self.interval, self._sample)
+
+    def _watch(self):
+        reported = None
+        while not self.stop_event.wait(min(self.threshold / 2, 1.0)):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # Report each stall only once
+            if blocked < self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            self.stalls += 1
+
+            frame = sys._current_frames().get(self.loop_thread_id, None)  # pylint: disable=protected-access
+            if frame is None:
+                continue
+            stack = ''.join(traceback.format_stack(frame))
+            logger.warning(f"IOLoop blocked for more than {blocked:.3f}s in {self._describe_owner(frame)}. Stack:\n{stack}")
+
+    @staticmethod
+    def _describe_owner(frame):
+        # Innermost link driver or request handler found on the stack
+        while frame is not None:
+            owner = frame.f_locals.get('self', None)
+            cfg_file = getattr(owner, 'cfg_file', None)
+            if cfg_file is not None:
+                return f"link `{cfg_file}`"
+            request = getattr(owner, 'request', None)
+            if request is not None and hasattr(request, 'uri'):
+                return f"handler `{owner.__class__.__name__}` ({request.method} {request.uri})"
+            frame = frame.f_back
+        return "unknown callback"
+
+    def get_stats(self):
+        samples = sorted(self.samples)
+
+        def percentile(value):
+            if not samples:
+                return None
+            return samples[min(len(samples) - 1, int(len(samples) * value))]
+
+        return {
+            'interval': self.interval,
+            'threshold': self.threshold,
+            'samples': len(samples),
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': samples[-1] if samples else None,
+            'stalls': self.stalls,
+        }
@@ -0,0 +1,120 @@
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LATENESS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Metric name, type and help text for everything `to_prometheus` knows about
+PROCESS_METRICS = {
+    'tick_seconds': ('apilink_scheduler_tick_seconds', 'histogram', 'Time spent dispatching due links in one scheduler tick'),
+    'links_loaded': ('apilink_links_loaded', 'gauge', 'Number of loaded links'),
+    'updates_in_flight': ('apilink_updates_in_flight', 'gauge', 'Link updates currently running'),
+    'http_requests_in_flight': ('apilink_http_requests_in_flight', 'gauge', 'Outgoing HTTP requests currently in flight'),
+    'http_requests': ('apilink_http_requests_total', 'counter', 'Outgoing HTTP requests started'),
+    'http_errors': ('apilink_http_errors_total', 'counter', 'Outgoing HTTP requests that failed'),
+    'server_connections': ('apilink_server_connections', 'gauge', 'Open connections to API Link server'),
+    'loop_lag_seconds': ('apilink_loop_lag_seconds', 'histogram', 'Delay of IOLoop running a periodic callback'),
+    'loop_stalls': ('apilink_loop_stalls_total', 'counter', 'Times IOLoop was blocked longer than the threshold'),
+    'datagram_lines': ('apilink_datagram_lines_total', 'counter', 'Values received by datagram listener'),
+    'datagram_errors': ('apilink_datagram_errors_total', 'counter', 'Malformed datagram lines and values for unknown links'),
+}
+LINK_METRICS = {
+    'fetch_seconds': ('apilink_link_fetch_seconds', 'histogram', 'Upstream API request latency'),
+    'parse_seconds': ('apilink_link_parse_seconds', 'histogram', 'Time spent decoding upstream response'),
+    'eval_seconds': ('apilink_link_eval_seconds', 'histogram', 'Time spent looking up configured item in response'),
+    'modifier_seconds': ('apilink_link_modifier_seconds', 'histogram', 'Time spent running value modifiers'),
+    'dial_seconds': ('apilink_dial_update_seconds', 'histogram', 'Latency of pushing changes to dial'),
+    'lateness_seconds': ('apilink_link_lateness_seconds', 'histogram', 'Delay between scheduled and actual start of link update'),
+    'errors': ('apilink_link_errors_total', 'counter', 'Failed link updates'),
+    'dial_errors': ('apilink_dial_errors_total', 'counter', 'Failed dial updates'),
+    'last_success': ('apilink_link_last_success_timestamp_seconds', 'gauge', 'Unix time of last successful link update'),
+}
+
+
+class Histogram:
+    '''
+    Fixed bucket histogram, recording a value is one bisect and two additions.
+    Cumulative bucket counts are only computed when metrics are read.
+    '''
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        buckets = {}
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            buckets[str(bound)] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class LinkMetrics:
+    __slots__ = ('fetch_seconds', 'parse_seconds', 'eval_seconds', 'modifier_seconds', 'lateness_seconds', 'errors', 'last_success')
+
+    def __init__(self):
+        self.fetch_seconds = Histogram()
+        self.parse_seconds = Histogram()
+        self.eval_seconds = Histogram()
+        self.modifier_seconds = Histogram()
+        self.lateness_seconds = Histogram(LATENESS_BUCKETS)
+        self.errors = 0
+        self.last_success = None
+
+    def to_dict(self):
+        return {
+            'fetch_seconds': self.fetch_seconds.to_dict(),
+            'parse_seconds': self.parse_seconds.to_dict(),
+            'eval_seconds': self.eval_seconds.to_dict(),
+            'modifier_seconds': self.modifier_seconds.to_dict(),
+            'lateness_seconds': self.lateness_seconds.to_dict(),
+            'errors': self.errors,
+            'last_success': self.last_success,
+        }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _append_samples(lines, name, kind, value, labels):
+    if kind == 'histogram':
+        for bound, count in value['buckets'].items():
+            lines.append(f"{name}_bucket{_format_labels({**labels, 'le': bound})} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {value['sum']}")
+        lines.append(f"{name}_count{_format_labels(labels)} {value['count']}")
+    elif value is not None:
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+
+def to_prometheus(snapshot):
+    # Render `LinkManager.get_metrics()` snapshot in Prometheus text exposition format
+    lines = []
+    for key, (name, kind, description) in PROCESS_METRICS.items():
+        if key not in snapshot['process']:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        _append_samples(lines, name, kind, snapshot['process'][key], {})
+
+    for key, (name, kind, description) in LINK_METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for link_file, link in snapshot['links'].items():
+            _append_samples(lines, name, kind, link[key], {'link': link_file, 'dial': link['dial']})
+
+    return '\n'.join(lines) + '\n'
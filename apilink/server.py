@@ -4,14 +4,77 @@ import signal
 import argparse
 import time
 import re
+import json
 from datetime import datetime as dt
 from mimetypes import guess_type
 from tornado.web import Application, RequestHandler, Finish, StaticFileHandler
-from tornado.ioloop import IOLoop, PeriodicCallback
-from base_logger import logger, set_logger_level
+from tornado.ioloop import IOLoop
+from base_logger import logger, set_logger_level, set_log_format
 from vu_notifications import show_error_msg, show_info_msg
 from vu_filesystem import VU_FileSystem
+from file_cache import FileCache
 from link_manager import LinkManager
+from loop_monitor import LoopMonitor
+from datagram_listener import DatagramListener
+
+# index.html and other files served by FileHandler
+static_cache = FileCache(max_bytes=4*1024*1024)
+
+def parse_range(header, size):
+    # Single `bytes=` range as (start, end) with end exclusive, None serves whole file, False if it can not be satisfied
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    start, separator, end = spec.strip().partition('-')
+    if not separator:
+        return None
+
+    try:
+        if not start:
+            # Last `end` bytes
+            length = int(end)
+            return (max(0, size - length), size) if length > 0 else False
+        start = int(start)
+        end = int(end) + 1 if end else None
+    except ValueError:
+        return None
+
+    # Last byte before first one makes the header invalid, it is ignored rather than rejected
+    if end is not None and end <= start:
+        return None
+    if start >= size:
+        return False
+    return start, size if end is None else min(end, size)
+
+def send_cached_file(handler, entry, content_type):
+    # Content hash is a strong validator, clients revalidate every time and get 304 while file is unchanged
+    handler.set_header('Content-Type', content_type)
+    handler.set_header('ETag', f'"{entry.digest}"')
+    handler.set_header('Cache-Control', 'no-cache')
+    handler.set_header('Accept-Ranges', 'bytes')
+
+    if handler.check_etag_header():
+        handler.set_status(304)
+        return handler.finish()
+
+    data = entry.data
+    range_header = handler.request.headers.get('Range', None)
+    # Range only applies to the version client already has
+    if_range = handler.request.headers.get('If-Range', None)
+    if range_header is not None and (if_range is None or if_range == f'"{entry.digest}"'):
+        byte_range = parse_range(range_header, len(data))
+        if byte_range is False:
+            handler.set_status(416)
+            handler.set_header('Content-Range', f'bytes */{len(data)}')
+            return handler.finish()
+        if byte_range is not None:
+            start, end = byte_range
+            handler.set_status(206)
+            handler.set_header('Content-Range', f'bytes {start}-{end - 1}/{len(data)}')
+            data = data[start:end]
+
+    handler.write(data)
+    return handler.finish()
 
 class BaseHandler(RequestHandler):
     def initialize(self, link_manager):
@@ -40,7 +103,36 @@ class BaseHandler(RequestHandler):
 class Status_Handler(BaseHandler):
     def get(self):
         logger.debug(f"Request:{self.__class__.__name__}")
-        return self.send_response(status='ok', message='API Link Up and Running')
+        return self.send_response(status='ok', message='API Link Up and Running', data={'loading_links': self.link_manager.is_loading()})
+
+class Server_Cache_Handler(BaseHandler):
+    def get(self):
+        logger.debug(f"Request:{self.__class__.__name__}")
+        return self.send_response(status='ok', data=self.link_manager.get_cache_stats())
+
+class Server_Http_Handler(BaseHandler):
+    def get(self):
+        logger.debug(f"Request:{self.__class__.__name__}")
+        return self.send_response(status='ok', data=self.link_manager.get_http_stats())
+
+class Server_Metrics_Handler(BaseHandler):
+    def get(self):
+        logger.debug(f"Request:{self.__class__.__name__}")
+        if self.get_argument('format', 'prometheus') == 'json':
+            return self.send_response(status='ok', data=self.link_manager.get_metrics())
+
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.link_manager.get_metrics_text())
+        return self.finish()
+
+class Server_Loop_Handler(BaseHandler):
+    def initialize(self, link_manager, loop_monitor): # pylint: disable=arguments-differ
+        super().initialize(link_manager)
+        self.loop_monitor = loop_monitor # pylint: disable=attribute-defined-outside-init
+
+    def get(self):
+        logger.debug(f"Request:{self.__class__.__name__}")
+        return self.send_response(status='ok', data=self.loop_monitor.get_stats())
 
 class Link_List_Handler(BaseHandler):
     def get(self):
@@ -51,19 +143,85 @@ class Link_List_Handler(BaseHandler):
 class Link_Reload_Handler(BaseHandler):
     def get(self):
         logger.debug(f"Request:{self.__class__.__name__}")
-        links = self.link_manager.reload_all_links()
+        # Only links whose file changed are re-created, unless full reload is requested
+        full = self.get_argument('full', 'false').lower() in ('1', 'true', 'yes')
+        links = self.link_manager.reload_all_links(full=full)
         return self.send_response(status='ok', data=links)
 
-class Link_Enable_Handler(BaseHandler):
+# HTTP status for each LinkManager.push_value result
+PUSH_STATUS_CODES = {
+    'ok': 200,
+    'unknown_link': 404,
+    'not_push_link': 400,
+    'disabled': 409,
+    'rate_limited': 429,
+    'invalid_value': 400,
+}
+
+class Link_Push_Handler(BaseHandler):
+    def post(self):
+        logger.debug(f"Request:{self.__class__.__name__}")
+        link_file = self.get_argument('link', None)
+        value = self.get_argument('value', None)
+
+        if link_file is None or value is None:
+            return self.send_response(status='fail', message='Link and value are required!', status_code=400)
+
+        result = self.link_manager.push_value(link_file, value)
+        if result == 'ok':
+            return self.send_response(status='ok')
+        return self.send_response(status='fail', message=result, status_code=PUSH_STATUS_CODES[result])
+
+class Link_Push_Batch_Handler(BaseHandler):
+    def post(self):
+        # Body is JSON object of link file -> value, response has result for each link
+        logger.debug(f"Request:{self.__class__.__name__}")
+        try:
+            values = json.loads(self.request.body)
+        except ValueError:
+            values = None
+        if not isinstance(values, dict):
+            return self.send_response(status='fail', message='Body must be JSON object of link -> value!', status_code=400)
+
+        results = {link_file: self.link_manager.push_value(link_file, value) for link_file, value in values.items()}
+        status = 'ok' if all(result == 'ok' for result in results.values()) else 'fail'
+        return self.send_response(status=status, data=results)
+
+class Link_History_Handler(BaseHandler):
     def get(self):
         logger.debug(f"Request:{self.__class__.__name__}")
         link_file = self.get_argument('link', None)
 
+        if link_file is None:
+            return self.send_response(status='fail', message='Invalid link file!', status_code=400)
+
+        # Negative `since` is relative to now, `step` groups samples into buckets of that many seconds
+        try:
+            since = float(self.get_argument('since', 0))
+            step = float(self.get_argument('step', 0))
+        except ValueError:
+            return self.send_response(status='fail', message='`since` and `step` must be numbers!', status_code=400)
+        if since < 0:
+            since += time.time()
+        if step < 0:
+            return self.send_response(status='fail', message='`step` must be positive!', status_code=400)
+
+        history = self.link_manager.get_link_history(link_file, since=since, step=step or None)
+        if history is None:
+            return self.send_response(status='fail', message='Link does not exist!', status_code=404)
+        return self.send_response(status='ok', data={'link': link_file, 'step': step or None, 'history': history})
+
+class Link_Enable_Handler(BaseHandler):
+    async def get(self):
+        logger.debug(f"Request:{self.__class__.__name__}")
+        link_file = self.get_argument('link', None)
+
         if link_file is None:
             logger.debug("Link file name is empty!")
             return self.send_response(status='fail', message='Invalid link file!')
 
-        if self.link_manager.enable_link(link_file):
+        res = await self.link_manager.enable_link(link_file)
+        if res:
             logger.info(f"Link `{link_file}` is now enabled.")
             return self.send_response(status='ok')
         return self.send_response(status='fail', message='Failed to enable link')
@@ -168,11 +326,10 @@ class Server_Reload_Handler(BaseHandler):
         return self.send_response(status='ok')
 
 class Link_Get_Image_Handler(BaseHandler):
-    def get(self):
+    async def get(self):
         image = self.get_argument('file', 'img_blank')
 
         logger.debug(f"Request:{self.__class__.__name__}: {image}")
-        self.set_header("Content-Type", "image/png")
         image_path = os.path.join(VU_FileSystem.get_link_images_folder_path(), image)
 
         if os.path.isfile(image_path):
@@ -183,13 +340,11 @@ class Link_Get_Image_Handler(BaseHandler):
             logger.debug(f"Serving DEFAULT image from {filepath}")
 
         try:
-            with open(filepath, 'rb') as f:
-                data = f.read()
-                self.write(data)
-            return self.finish()
+            entry = await self.link_manager.get_image(filepath)
         except IOError as e:
             logger.error(e)
             return self.send_response(status='fail', message='Internal sever error!', status_code=500)
+        return send_cached_file(self, entry, 'image/png')
 
 class Link_Image_List_Handler(BaseHandler):
     def get(self):
@@ -209,6 +364,7 @@ class Link_Image_Delete_Handler(BaseHandler):
 
         if os.path.isfile(image_path):
             os.remove(image_path)
+            self.link_manager.invalidate_image(image_path)
             logger.debug(f"Deleting image `{image_path}`")
             return self.send_response(status='ok', message='Image removed')
 
@@ -249,6 +405,7 @@ class Link_Image_Upload_Handler(BaseHandler):
         file_path = os.path.join(VU_FileSystem.get_link_images_folder_path(), f"{image_name}.png")
         with open(file_path, 'wb') as img:
             img.write(image_data[0]['body'])
+        self.link_manager.invalidate_image(file_path)
 
         logger.debug(f"Image uploaded to `{file_path}`.")
         return self.send_response(status='ok')
@@ -264,7 +421,7 @@ class Default_404_Handler(RequestHandler):
         raise Finish()
 
 class FileHandler(RequestHandler):
-    def get(self, path=None):
+    async def get(self, path=None):
         if path:
             logger.debug(f"Requesting: {path}")
             file_location = os.path.join(VU_FileSystem.get_www_folder_path(), path)
@@ -278,19 +435,39 @@ class FileHandler(RequestHandler):
             self.write(resp)
             raise Finish()
         content_type, _ = guess_type(file_location)
-        self.add_header('Content-Type', content_type)
-        with open(file_location, encoding="utf-8") as source_file:
-            self.write(source_file.read())
+        entry = await static_cache.get_async(file_location)
+        send_cached_file(self, entry, content_type or 'application/octet-stream')
 
 
 class VU_API_Link(Application):
-    def __init__(self):
+    def __init__(self, config=None):
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGINT, self.signal_handler)
 
         logger.info("Loading server config...")
-        self.config = None
-        self.link_manager = LinkManager()
+        if config is None:
+            config = get_argument_parser().parse_args([])
+        self.config = config
+        http_client_options = {
+            'client': self.config.http_client,
+            'max_clients': self.config.http_max_clients,
+            'max_per_host': self.config.http_max_per_host,
+            'gzip': self.config.http_gzip,
+            'connect_timeout': self.config.http_connect_timeout,
+            'request_timeout': self.config.http_request_timeout,
+        }
+        self.link_manager = LinkManager(max_concurrent_updates=self.config.max_concurrent_updates,
+                                        schedule_jitter=self.config.schedule_jitter,
+                                        http_client_options=http_client_options,
+                                        watch_interval=self.config.watch_links,
+                                        history_size=self.config.history_size)
+        self.loop_monitor = LoopMonitor(interval=self.config.loop_lag_interval, threshold=self.config.loop_lag_threshold)
+        self.link_manager.add_gauge('loop_lag_seconds', self.loop_monitor.lag_seconds.to_dict)
+        self.link_manager.add_gauge('loop_stalls', lambda: self.loop_monitor.stalls)
+        self.datagram_listener = DatagramListener(self.link_manager, udp_port=self.config.datagram_port, udp_host=self.config.datagram_host,
+                                                  unix_path=self.config.datagram_socket, window=self.config.datagram_window)
+        self.link_manager.add_gauge('datagram_lines', lambda: self.datagram_listener.lines)
+        self.link_manager.add_gauge('datagram_errors', lambda: self.datagram_listener.errors)
 
         shared_resources = { "link_manager":self.link_manager }
 
@@ -303,6 +480,9 @@ class VU_API_Link(Application):
             ("/api/v0/link/write", Link_Write_Handler, shared_resources),
             ("/api/v0/link/update", Link_Update_Handler, shared_resources),
             ("/api/v0/link/delete", Link_Delete_Handler, shared_resources),
+            ("/api/v0/link/history", Link_History_Handler, shared_resources),
+            ("/api/v0/link/push", Link_Push_Handler, shared_resources),
+            ("/api/v0/link/push/batch", Link_Push_Batch_Handler, shared_resources),
             ("/api/v0/image/get", Link_Get_Image_Handler, shared_resources),
             ("/api/v0/image/list", Link_Image_List_Handler, shared_resources),
             ("/api/v0/image/upload", Link_Image_Upload_Handler, shared_resources),
@@ -311,6 +491,10 @@ class VU_API_Link(Application):
             ("/api/v0/time/datetime", Time_DateTime_Handler, shared_resources),
             ("/api/v0/server/status", Status_Handler, shared_resources),
             ("/api/v0/server/reload", Server_Reload_Handler, shared_resources),
+            ("/api/v0/server/cache", Server_Cache_Handler, shared_resources),
+            ("/api/v0/server/http", Server_Http_Handler, shared_resources),
+            ("/api/v0/server/metrics", Server_Metrics_Handler, shared_resources),
+            ("/api/v0/server/loop", Server_Loop_Handler, {**shared_resources, "loop_monitor": self.loop_monitor}),
 
             ("/", FileHandler),
             (r'/(.*)', StaticFileHandler, {'path': VU_FileSystem.get_www_folder_path()}),
@@ -325,12 +509,16 @@ class VU_API_Link(Application):
 
     def signal_handler(self, signal, frame):
         IOLoop.current().add_callback_from_signal(self.shutdown_server)
+        self.link_manager.flush_configs()
         print('\r\nYou pressed Ctrl+C!')
         show_info_msg("CTRL+C", "CTRL+C pressed.\r\nVU API Link app will exit now.")  # Remove if becomes annoying
         sys.exit(0)
 
     def shutdown_server(self):
         logger.info('Stopping API server')
+        self.link_manager.stop()
+        self.loop_monitor.stop()
+        self.datagram_listener.stop()
         logger.info('Will shutdown in 3 seconds ...')
         io_loop = IOLoop.instance()
         deadline = time.time() + 3
@@ -352,22 +540,65 @@ class VU_API_Link(Application):
         # port = server_config.get('port', 5340)
         # dial_update_period = server_config.get('dial_update_period', 1000)
         port = 5341
-        scheduler_period = 500
         logger.info(f"VU1 API LINK is listening on http://localhost:{port}")
 
-        pc = PeriodicCallback(self.link_manager.async_periodic_update, scheduler_period)
-        pc.start()
+        self.link_manager.start()
+        self.loop_monitor.start()
+        self.datagram_listener.start()
 
-        app.listen(port)
+        # Links load in the background, API is available right away
+        server = app.listen(port)
+        IOLoop.current().spawn_callback(self.link_manager.load_links)
+        self.link_manager.add_gauge('server_connections', lambda: len(server._connections))  # pylint: disable=protected-access
         IOLoop.instance().start()
 
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description='Karanovic Research - VU API Link')
+    parser.add_argument('-l', '--logging', type=str, default='debug', help='Set logging level. Default is `info`')
+    parser.add_argument('--log-format', type=str, default='text', choices=['text', 'json'],
+                        help='Write log as plain text or as one JSON object per line. Default is `text`')
+    parser.add_argument('--max-concurrent-updates', type=int, default=16,
+                        help='Maximum number of links allowed to update at the same time. Default is `16`')
+    parser.add_argument('--schedule-jitter', type=float, default=5.0,
+                        help='Spread first update of links loaded together over up to this many seconds. Default is `5`')
+    parser.add_argument('--watch-links', type=float, default=0,
+                        help='Check link files for changes every this many seconds and reload changed links, 0 to disable. Default is `0`')
+    parser.add_argument('--http-client', type=str, default='simple', choices=['simple', 'curl'],
+                        help='HTTP client used for API polls and dial updates, `curl` requires pycurl. Default is `simple`')
+    parser.add_argument('--http-max-clients', type=int, default=64,
+                        help='Maximum number of HTTP requests in flight at the same time. Default is `64`')
+    parser.add_argument('--http-max-per-host', type=int, default=0,
+                        help='Maximum number of HTTP requests in flight to a single host, 0 for no limit. Default is `0`')
+    parser.add_argument('--http-no-gzip', dest='http_gzip', action='store_false',
+                        help='Do not ask servers for gzip compressed responses')
+    parser.add_argument('--http-connect-timeout', type=float, default=20.0,
+                        help='Default connect timeout in seconds, links can override it. Default is `20`')
+    parser.add_argument('--http-request-timeout', type=float, default=20.0,
+                        help='Default request timeout in seconds, links can override it. Default is `20`')
+    parser.add_argument('--loop-lag-interval', type=float, default=0.5,
+                        help='How often IOLoop lag is sampled, in seconds. Default is `0.5`')
+    parser.add_argument('--loop-lag-threshold', type=float, default=0.25,
+                        help='Log stack of IOLoop thread when it is blocked longer than this many seconds, 0 to disable. Default is `0.25`')
+    parser.add_argument('--history-size', type=int, default=1024,
+                        help='Values kept in memory per link for history API (24 bytes each), 0 to disable. Links can override it. Default is `1024`')
+    parser.add_argument('--datagram-port', type=int, default=0,
+                        help='UDP port for `link_name:value` lines sent to push links, 0 to disable. Default is `0`')
+    parser.add_argument('--datagram-host', type=str, default='127.0.0.1',
+                        help='Address UDP listener binds to. Default is `127.0.0.1`')
+    parser.add_argument('--datagram-socket', type=str, default=None,
+                        help='Path of Unix datagram socket for `link_name:value` lines. Default is disabled')
+    parser.add_argument('--datagram-window', type=float, default=1.0,
+                        help='Values received within this many seconds are combined into one link update. Default is `1`')
+    return parser
+
 def main(cmd_args=None):
     if cmd_args is None:
         set_logger_level('info')
     else:
         set_logger_level(cmd_args.logging)
+        set_log_format(cmd_args.log_format)
     try:
-        VU_API_Link().run_forever()
+        VU_API_Link(cmd_args).run_forever()
     except Exception:
         logger.exception("VU API Link service crashed during setup.")
         show_error_msg("Crashed", "VU API Link has crashed unexpectedly!\r\nPlease check log files for more information.")
@@ -375,7 +606,5 @@ def main(cmd_args=None):
     sys.exit(0)
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Karanovic Research - VU API Link')
-    parser.add_argument('-l', '--logging', type=str, default='debug', help='Set logging level. Default is `info`')
-    args = parser.parse_args()
+    args = get_argument_parser().parse_args()
     main(args)
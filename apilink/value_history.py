@@ -0,0 +1,99 @@
+import math
+from array import array
+
+
+class ValueHistory:
+    '''
+    Fixed size ring buffer of (timestamp, raw value, final value) samples.
+
+    Samples are kept in three `array('d')` columns, 24 bytes per sample and
+    no per-sample objects. Columns grow up to `size` samples and are then
+    overwritten oldest first. Raw values that are not numbers are stored as
+    NaN and reported as None.
+    '''
+    __slots__ = ('size', 'times', 'raw', 'values', 'next')
+
+    def __init__(self, size):
+        self.size = max(0, int(size))
+        self.times = array('d')
+        self.raw = array('d')
+        self.values = array('d')
+        self.next = 0   # Slot written next once buffer is full
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, timestamp, raw, value):
+        if not self.size:
+            return
+        try:
+            raw = float(raw)
+        except (TypeError, ValueError):
+            raw = math.nan
+
+        if len(self.times) < self.size:
+            self.times.append(timestamp)
+            self.raw.append(raw)
+            self.values.append(float(value))
+            return
+
+        index = self.next
+        self.times[index] = timestamp
+        self.raw[index] = raw
+        self.values[index] = float(value)
+        self.next = (index + 1) % self.size
+
+    def _ordered(self, since):
+        # Indexes oldest to newest, starting at first sample newer than `since`
+        count = len(self.times)
+        start = self.next if count == self.size else 0
+        for offset in range(count):
+            index = (start + offset) % count
+            if self.times[index] >= since:
+                yield index
+
+    def get_points(self, since=0.0):
+        return [[self.times[index], _number(self.raw[index]), self.values[index]] for index in self._ordered(since)]
+
+    def get_buckets(self, step, since=0.0):
+        # Samples grouped into `step` seconds long buckets aligned to unix time, empty buckets are skipped
+        buckets = []
+        last_start = None
+        for index in self._ordered(since):
+            start = self.times[index] // step * step
+            if start != last_start:
+                value, raw = _Aggregate(), _Aggregate()
+                buckets.append((start, value, raw))
+                last_start = start
+            value.add(self.values[index])
+            raw.add(self.raw[index])
+
+        return [{'time': start, 'count': value.count, 'min': value.min, 'max': value.max, 'avg': value.avg(),
+                 'raw_min': raw.min, 'raw_max': raw.max, 'raw_avg': raw.avg()} for start, value, raw in buckets]
+
+
+class _Aggregate:
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if math.isnan(value):
+            return
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def avg(self):
+        return self.total / self.count if self.count else None
+
+
+def _number(value):
+    return None if math.isnan(value) else value
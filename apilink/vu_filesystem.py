@@ -140,6 +140,9 @@ class FileSystem:
     def get_links_folder_path(self):
         return os.path.join(self.base_path, 'links')
 
+    def get_link_cache_file_path(self):
+        return os.path.join(self.base_path, 'link_cache.json')
+
     def get_link_images_folder_path(self):
         return os.path.join(self.get_links_folder_path(), 'images')
 
@@ -0,0 +1,79 @@
+'''
+Stand-in upstream JSON API and VU server used by the load benchmark.
+
+Upstream API:
+    GET /api/value/<id>?latency=<seconds>&fail=<rate>
+        Returns `{"data": {"value": <0-100>}}` after `latency` seconds,
+        or `500` for `fail` share of requests.
+
+VU server:
+    GET  /api/v0/dial/<uid>/set
+    GET  /api/v0/dial/<uid>/backlight
+    POST /api/v0/dial/<uid>/image/set
+
+    GET /stats
+        Request counters, used by the benchmark to measure throughput.
+'''
+import sys
+import random
+import asyncio
+import argparse
+from collections import Counter
+from tornado.web import Application, RequestHandler
+from tornado.ioloop import IOLoop
+
+stats = Counter()
+
+
+class UpstreamHandler(RequestHandler):
+    async def get(self, _):
+        latency = float(self.get_argument('latency', 0))
+        failure_rate = float(self.get_argument('fail', 0))
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+        if failure_rate > 0 and random.random() < failure_rate:
+            stats['upstream_failures'] += 1
+            self.set_status(500)
+            return self.finish()
+
+        stats['polls'] += 1
+        return self.write({'data': {'value': random.randint(0, 100)}})
+
+
+class DialHandler(RequestHandler):
+    def get(self, _, action):
+        stats[f'dial_{action}'] += 1
+        # Real VU server answers 201 when it changed something
+        self.set_status(201 if action == 'backlight' else 200)
+        self.write({'status': 'ok'})
+
+    def post(self, _, action):
+        stats[f'dial_{action.replace("/", "_")}'] += 1
+        self.set_status(201)
+        self.write({'status': 'ok'})
+
+
+class StatsHandler(RequestHandler):
+    def get(self):
+        self.write(dict(stats))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake upstream API and VU server for API Link benchmarks')
+    parser.add_argument('--port', type=int, default=5399)
+    args = parser.parse_args()
+
+    app = Application([
+        (r'/api/value/([^/]+)', UpstreamHandler),
+        (r'/api/v0/dial/([^/]+)/(set|backlight|image/set)', DialHandler),
+        (r'/stats', StatsHandler),
+    ])
+    app.listen(args.port, address='127.0.0.1')
+    print(f'listening on {args.port}', flush=True)
+    IOLoop.current().start()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
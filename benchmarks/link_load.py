@@ -0,0 +1,301 @@
+'''
+End-to-end load benchmark for API Link.
+
+Starts `fake_services.py` (stand-in upstream API and VU server) in a
+subprocess, generates N link files into a temporary `VU_SERVER_DATA_PATH`
+and runs `LinkManager` against them for a fixed time. Every link count runs
+in a fresh worker process.
+
+Reported per link count:
+    polls/s and dial writes/s (counted by the fake services)
+    link update errors
+    schedule lateness (mean and histogram based percentiles)
+    IOLoop lag
+    CPU use and max RSS of the worker process
+
+Results are printed as JSON to stdout (and `--output`), summary goes to stderr.
+
+Example:
+    python benchmarks/link_load.py --links 10,100,1000 --duration 30 --latency 0.05 --failure-rate 0.01
+
+Fake services run in a single process on the same machine, at high link
+counts with short update periods they can become the bottleneck.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVICES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_services.py')
+
+LINK_TEMPLATE = '''[info]
+name = "Benchmark {index}"
+description = "Generated by link_load.py"
+enabled = true
+image = "bench.png"
+
+[api]
+url = "http://127.0.0.1:{port}/api/value/{url_id}?latency={latency}&fail={failure_rate}"
+item = "response['data']['value']"
+update_period = {update_period}
+
+[dial]
+uid = "BENCH{index:05d}"
+host = "127.0.0.1"
+port = {port}
+api_key = "benchmark"
+
+[backlight_map]
+0 = [0, 100, 0]
+50 = [100, 100, 0]
+80 = [100, 0, 0]
+'''
+
+
+def get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def generate_links(data_path, count, args):
+    links_path = os.path.join(data_path, 'KaranovicResearch', 'APILink', 'links')
+    os.makedirs(os.path.join(links_path, 'images'), exist_ok=True)
+
+    # Fake VU server does not look at the image, content only has to be stable
+    with open(os.path.join(links_path, 'images', 'bench.png'), 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n' + b'\0' * 64)
+
+    for index in range(count):
+        url_id = index % args.shared_urls if args.shared_urls else index
+        content = LINK_TEMPLATE.format(index=index, port=args.port, url_id=url_id, latency=args.latency,
+                                       failure_rate=args.failure_rate, update_period=args.update_period)
+        with open(os.path.join(links_path, f'requests_bench_{index}.toml'), 'w', encoding='utf-8') as file:
+            file.write(content)
+
+
+def merge_histograms(histograms):
+    merged = {'count': 0, 'sum': 0.0, 'buckets': {}}
+    for histogram in histograms:
+        merged['count'] += histogram['count']
+        merged['sum'] += histogram['sum']
+        for bound, count in histogram['buckets'].items():
+            merged['buckets'][bound] = merged['buckets'].get(bound, 0) + count
+    return merged
+
+
+def subtract_histograms(after, before):
+    return {
+        'count': after['count'] - before['count'],
+        'sum': after['sum'] - before['sum'],
+        'buckets': {bound: count - before['buckets'].get(bound, 0) for bound, count in after['buckets'].items()},
+    }
+
+
+def histogram_percentile(histogram, value):
+    # Upper bound of the bucket holding the percentile
+    if not histogram['count']:
+        return None
+    rank = histogram['count'] * value
+    for bound, count in histogram['buckets'].items():
+        if count >= rank:
+            return float(bound) if bound != '+Inf' else bound
+    return '+Inf'
+
+
+def run_worker(args):
+    # pylint: disable=import-outside-toplevel
+    # Imported here because VU_FileSystem picks data path on import
+    from tornado.ioloop import IOLoop
+    from tornado.httpclient import AsyncHTTPClient
+    from apilink.base_logger import logger
+    from apilink.link_manager import LinkManager
+    from apilink.loop_monitor import LoopMonitor
+
+    if not args.verbose:
+        logger.setLevel('CRITICAL')
+
+    async def get_fake_stats():
+        response = await AsyncHTTPClient().fetch(f'http://127.0.0.1:{args.port}/stats')
+        return json.loads(response.body)
+
+    def get_link_totals(manager):
+        links = manager.get_metrics()['links'].values()
+        return {
+            'lateness': merge_histograms(link['lateness_seconds'] for link in links),
+            'errors': sum(link['errors'] + link['dial_errors'] for link in links),
+        }
+
+    async def measure():
+        started = time.perf_counter()
+        manager = LinkManager(max_concurrent_updates=args.max_concurrent_updates,
+                              schedule_jitter=args.update_period,
+                              http_client_options={'client': args.http_client, 'max_clients': args.http_max_clients})
+        await manager.load_links()
+        load_seconds = time.perf_counter() - started
+
+        monitor = LoopMonitor(interval=0.1, threshold=0)
+        manager.start()
+        monitor.start()
+
+        # First updates are spread over one update period
+        await asyncio.sleep(args.warmup)
+        fake_before = await get_fake_stats()
+        links_before = get_link_totals(manager)
+        cpu_before = time.process_time()
+        wall_before = time.perf_counter()
+        monitor.samples.clear()
+
+        await asyncio.sleep(args.duration)
+        fake_after = await get_fake_stats()
+        links_after = get_link_totals(manager)
+        cpu_seconds = time.process_time() - cpu_before
+        elapsed = time.perf_counter() - wall_before
+
+        manager.stop()
+        monitor.stop()
+
+        def rate(key):
+            return (fake_after.get(key, 0) - fake_before.get(key, 0)) / elapsed
+
+        lateness = subtract_histograms(links_after['lateness'], links_before['lateness'])
+        loop = monitor.get_stats()
+        return {
+            'links': len(manager.links),
+            'duration': elapsed,
+            'load_seconds': load_seconds,
+            'polls_per_sec': rate('polls'),
+            'upstream_failures_per_sec': rate('upstream_failures'),
+            'dial_writes_per_sec': rate('dial_set') + rate('dial_backlight') + rate('dial_image_set'),
+            'errors': links_after['errors'] - links_before['errors'],
+            'lateness': {
+                'updates': lateness['count'],
+                'mean': lateness['sum'] / lateness['count'] if lateness['count'] else None,
+                'p50': histogram_percentile(lateness, 0.5),
+                'p90': histogram_percentile(lateness, 0.9),
+                'p99': histogram_percentile(lateness, 0.99),
+            },
+            'loop_lag': {'p50': loop['p50'], 'p99': loop['p99'], 'max': loop['max']},
+            'cpu_percent': 100.0 * cpu_seconds / elapsed,
+            'rss_max_mb': get_max_rss_mb(),
+        }
+
+    result = IOLoop.current().run_sync(measure)
+    print(json.dumps(result), flush=True)
+
+
+def get_max_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def run_benchmark(count, args):
+    with tempfile.TemporaryDirectory(prefix='apilink_bench_') as data_path:
+        generate_links(data_path, count, args)
+
+        env = dict(os.environ)
+        env['VU_SERVER_DATA_PATH'] = data_path
+        env['PYTHONPATH'] = os.pathsep.join([REPO_PATH, os.path.join(REPO_PATH, 'apilink')])
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--links', str(count)] + get_worker_args(args)
+        completed = subprocess.run(command, env=env, cwd=os.path.join(REPO_PATH, 'apilink'),
+                                   stdout=subprocess.PIPE, check=True, timeout=args.warmup + args.duration + 600)
+
+    result = json.loads(completed.stdout.decode().strip().splitlines()[-1])
+    result['config'] = {
+        'update_period': args.update_period,
+        'latency': args.latency,
+        'failure_rate': args.failure_rate,
+        'shared_urls': args.shared_urls,
+        'max_concurrent_updates': args.max_concurrent_updates,
+        'http_client': args.http_client,
+        'http_max_clients': args.http_max_clients,
+    }
+    return result
+
+
+def get_worker_args(args):
+    worker_args = ['--port', str(args.port), '--duration', str(args.duration), '--warmup', str(args.warmup),
+                   '--update-period', str(args.update_period), '--max-concurrent-updates', str(args.max_concurrent_updates),
+                   '--http-client', args.http_client, '--http-max-clients', str(args.http_max_clients)]
+    if args.verbose:
+        worker_args.append('--verbose')
+    return worker_args
+
+
+def print_summary(result):
+    lateness = result['lateness']
+    mean = f"{lateness['mean'] * 1000:.1f}ms" if lateness['mean'] is not None else '-'
+    print(f"links={result['links']:<6} polls/s={result['polls_per_sec']:<8.1f} dial writes/s={result['dial_writes_per_sec']:<8.1f} "
+          f"errors={result['errors']:<5} lateness mean={mean} p99<={lateness['p99']}s "
+          f"loop lag max={result['loop_lag']['max'] or 0:.3f}s cpu={result['cpu_percent']:.0f}% rss={result['rss_max_mb'] or 0:.0f}MB",
+          file=sys.stderr)
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(description='Karanovic Research - VU API Link load benchmark')
+    parser.add_argument('--links', type=str, default='10,100,1000,10000', help='Comma separated link counts. Default is `10,100,1000,10000`')
+    parser.add_argument('--duration', type=float, default=30.0, help='Measured time per link count in seconds. Default is `30`')
+    parser.add_argument('--warmup', type=float, default=None, help='Time before measuring starts. Default is one update period')
+    parser.add_argument('--update-period', type=int, default=5, help='`update_period` of generated links. Default is `5`')
+    parser.add_argument('--latency', type=float, default=0.0, help='Upstream API response delay in seconds. Default is `0`')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Share of upstream requests failing with 500. Default is `0`')
+    parser.add_argument('--shared-urls', type=int, default=0, help='Spread links over this many upstream URLs, 0 gives every link its own. Default is `0`')
+    parser.add_argument('--max-concurrent-updates', type=int, default=16, help='Passed to LinkManager. Default is `16`')
+    parser.add_argument('--http-client', type=str, default='simple', choices=['simple', 'curl'], help='Default is `simple`')
+    parser.add_argument('--http-max-clients', type=int, default=64, help='Default is `64`')
+    parser.add_argument('--port', type=int, default=None, help='Port for fake services. Default is any free port')
+    parser.add_argument('--output', type=str, default=None, help='Also write JSON results to this file')
+    parser.add_argument('--verbose', action='store_true', help='Keep API Link logging enabled in workers')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    return parser
+
+
+def main():
+    args = get_argument_parser().parse_args()
+    if args.warmup is None:
+        args.warmup = float(args.update_period)
+
+    if args.worker:
+        run_worker(args)
+        return 0
+
+    if args.port is None:
+        args.port = get_free_port()
+
+    fake = subprocess.Popen([sys.executable, FAKE_SERVICES, '--port', str(args.port)], stdout=subprocess.PIPE)
+    try:
+        fake.stdout.readline()  # Wait until it is listening
+
+        results = []
+        for count in [int(value) for value in args.links.split(',') if value.strip()]:
+            result = run_benchmark(count, args)
+            print_summary(result)
+            results.append(result)
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    output = json.dumps({'timestamp': time.time(), 'results': results}, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())